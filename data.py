@@ -1,116 +1,202 @@
+import functools
 import json
 import os
 import numpy as np
 from PIL import Image
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 import tqdm
 import concurrent.futures
 import pickle
 import torch
-from torchvision import transforms
 from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 from utils.parser_utils import get_args
 
 
-class rotate_image(object):
+def get_num_cpu_workers():
+    """
+    Returns the number of CPU cores this process may run on, used to size the image decoding process pools.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
 
-    def __init__(self, k, channels):
-        self.k = k
-        self.channels = channels
-
-    def __call__(self, image):
-        if self.channels == 1 and len(image.shape) == 3:
-            image = image[:, :, 0]
-            image = np.expand_dims(image, axis=2)
 
-        elif self.channels == 1 and len(image.shape) == 4:
-            image = image[:, :, :, 0]
-            image = np.expand_dims(image, axis=3)
+class tensor_rotate_image(object):
 
-        image = np.rot90(image, k=self.k).copy()
-        return image
+    def __init__(self, k):
+        self.k = k
 
+    def __call__(self, images):
+        """
+        Rotates a batch of (..., c, h, w) image tensors by k * 90 degrees
+        """
+        return torch.rot90(images, k=self.k, dims=(-2, -1))
 
-class torch_rotate_image(object):
 
-    def __init__(self, k, channels):
-        self.k = k
-        self.channels = channels
-
-    def __call__(self, image):
-        rotate = transforms.RandomRotation(degrees=self.k * 90)
-        if image.shape[-1] == 1:
-            image = image[:, :, 0]
-        image = Image.fromarray(image)
-        image = rotate(image)
-        image = np.array(image)
-        if len(image.shape) == 2:
-            image = np.expand_dims(image, axis=2)
-        return image
+class tensor_normalize(object):
 
+    def __init__(self, mean, std):
+        self.mean = mean
+        self.std = std
+        self.mean_std_per_device = dict()
 
-def augment_image(image, k, channels, augment_bool, args, dataset_name):
-    transform_train, transform_evaluation = get_transforms_for_dataset(dataset_name=dataset_name,
-                                                                       args=args, k=k)
-    if len(image.shape) > 3:
-        images = [item for item in image]
-        output_images = []
-        for image in images:
-            if augment_bool is True:
-                for transform_current in transform_train:
-                    image = transform_current(image)
-            else:
-                for transform_current in transform_evaluation:
-                    image = transform_current(image)
-            output_images.append(image)
-        image = torch.stack(output_images)
+    def __call__(self, images):
+        """
+        Normalizes a batch of (..., c, h, w) image tensors on whichever device they live, the batched equivalent of
+        transforms.Normalize. The constant tensors are built once per device and dtype.
+        """
+        key = (images.device, images.dtype)
+        if key not in self.mean_std_per_device:
+            self.mean_std_per_device[key] = (
+                torch.tensor(self.mean, dtype=images.dtype, device=images.device).view(-1, 1, 1),
+                torch.tensor(self.std, dtype=images.dtype, device=images.device).view(-1, 1, 1))
+        mean, std = self.mean_std_per_device[key]
+        return (images - mean) / std
+
+
+def augment_episode(images, k_list, augment_bool, dataset_name):
+    """
+    Converts a whole episode to a tensor at once and applies the dataset's normalization, or for omniglot the
+    per-class rotations, as a few batched tensor ops.
+    :param images: An episode image array of shape (num_classes, num_samples, h, w, c). Raw uint8 images are
+    scaled here, any other dtype is taken as already scaled.
+    :param k_list: The number of 90 degree rotations of each class
+    :param augment_bool: Whether to apply the train (True) or evaluation (False) transforms
+    :param dataset_name: The name of the dataset, used to pick the transforms
+    :return: An episode image tensor of shape (num_classes, num_samples, c, h, w)
+    """
+    if images.dtype == np.uint8:
+        images = scale_raw_episode(torch.from_numpy(np.ascontiguousarray(images)), dataset_name=dataset_name)
     else:
-        if augment_bool is True:
-            # meanstd transformation
-            for transform_current in transform_train:
-                image = transform_current(image)
+        images = torch.from_numpy(np.ascontiguousarray(images, dtype=np.float32))
+    images = images.permute(0, 1, 4, 2, 3).contiguous()
+
+    return apply_episode_transforms(images=images, k_list=k_list, augment_bool=augment_bool,
+                                    dataset_name=dataset_name)
+
+
+def get_raw_image_divisor(dataset_name):
+    """
+    Returns the value raw uint8 images are divided by when converted to float, omniglot images are kept unscaled.
+    """
+    return 1.0 if 'omniglot' in dataset_name else 255.0
+
+
+def scale_raw_episode(images, dataset_name):
+    """
+    Converts a raw uint8 image tensor to float32 on whichever device it lives, scaled by get_raw_image_divisor().
+    """
+    return images.float() / get_raw_image_divisor(dataset_name=dataset_name)
+
+
+def apply_episode_transforms(images, k_list, augment_bool, dataset_name):
+    """
+    Applies the cached episode transforms of a dataset to an episode tensor, on the device the tensor lives on.
+    Classes sharing the same transforms (e.g. the same rotation) are transformed together in one batched op.
+    :param images: An episode image tensor of shape (num_classes, num_samples, c, h, w)
+    :param k_list: The number of 90 degree rotations of each class
+    :param augment_bool: Whether to apply the train (True) or evaluation (False) transforms
+    :param dataset_name: The name of the dataset, used to pick the transforms
+    :return: The transformed episode image tensor
+    """
+    class_transforms = [get_episode_transforms(dataset_name=dataset_name, k=int(k), augment_bool=augment_bool)
+                        for k in k_list]
+    unique_transforms = {id(transform_list): transform_list for transform_list in class_transforms}
+
+    for transform_list_id, transform_list in unique_transforms.items():
+        if len(unique_transforms) == 1:
+            for transform_current in transform_list:
+                images = transform_current(images)
         else:
-            for transform_current in transform_evaluation:
-                image = transform_current(image)
-    return image
-
-
-def get_transforms_for_dataset(dataset_name, args, k):
+            class_idx = torch.tensor([idx for idx, class_transform_list in enumerate(class_transforms)
+                                      if id(class_transform_list) == transform_list_id], device=images.device)
+            class_images = images[class_idx]
+            for transform_current in transform_list:
+                class_images = transform_current(class_images)
+            images[class_idx] = class_images
+
+    return images
+
+
+def get_episode_transforms(dataset_name, k, augment_bool):
+    """
+    Returns the tensor transforms for a class of an episode. Rotations only apply to augmented omniglot episodes, so
+    everywhere else k is ignored and all classes of an episode share the same (cached) transforms.
+    :param dataset_name: The name of the dataset
+    :param k: The number of 90 degree rotations of the class
+    :param augment_bool: Whether to return the train (True) or evaluation (False) transforms
+    :return: A list of tensor transforms, shared across calls with the same arguments
+    """
+    if augment_bool is not True or 'omniglot' not in dataset_name:
+        k = 0
+    return build_episode_transforms(dataset_name=dataset_name, k=k % 4)
+
+
+@functools.lru_cache(maxsize=None)
+def build_episode_transforms(dataset_name, k):
+    transform_list = []
+    if k != 0:
+        transform_list.append(tensor_rotate_image(k=k))
+
+    normalization = get_normalization_for_dataset(dataset_name=dataset_name)
+    if normalization is not None:
+        transform_list.append(tensor_normalize(*normalization))
+
+    return transform_list
+
+
+def get_normalization_for_dataset(dataset_name):
+    """
+    Returns the per-channel (mean, std) normalization constants of a dataset, or None if it is not normalized.
+    """
     if "cifar10" in dataset_name or "cifar100" in dataset_name or "FC100" in dataset_name:
-        transform_train = [
-            transforms.ToTensor(),
-            transforms.Normalize((0.5071, 0.4847, 0.4408), (0.2675, 0.2565, 0.2761))]
-
-            #transforms.RandomCrop(32, padding=4),
-            #transforms.RandomHorizontalFlip(),
-            #transforms.ToTensor(),
-            #transforms.Normalize(args.classification_mean, args.classification_std)]
-
-        transform_evaluate = [
-            transforms.ToTensor(),
-            transforms.Normalize((0.5071, 0.4847, 0.4408), (0.2675, 0.2565, 0.2761))]
-            #transforms.ToTensor(),
-            #transforms.Normalize(args.classification_mean, args.classification_std)]
-
-    elif 'omniglot' in dataset_name:
-
-        transform_train = [rotate_image(k=k, channels=args.image_channels), transforms.ToTensor()]
-        transform_evaluate = [transforms.ToTensor()]
-
-
+        return (0.5071, 0.4847, 0.4408), (0.2675, 0.2565, 0.2761)
     elif 'imagenet' in dataset_name:
+        return (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+    return None
 
-        transform_train = [transforms.Compose([
 
-            transforms.ToTensor(), transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))])]
+class DeviceEpisodePreprocessor(object):
+    def __init__(self, dataset_name, reverse_channels, device):
+        """
+        Device-side episode preprocessing stage. Takes the raw uint8 episodes produced by a dataset with
+        device_side_preprocessing enabled and applies the channel reversal, scaling, per-class rotation and
+        normalization as batched tensor ops on the given device (which may as well be the CPU), such that the data
+        provider workers only index the stored images.
+        :param dataset_name: The name of the dataset, used to pick the transforms
+        :param reverse_channels: Whether to reverse the channels of the images
+        :param device: The device to preprocess the episodes on
+        """
+        self.dataset_name = dataset_name
+        self.reverse_channels = reverse_channels
+        self.device = device
 
-        transform_evaluate = [transforms.Compose([
+    def __call__(self, x_support_set, x_target_set, rotations):
+        """
+        Preprocesses a batch of raw episodes.
+        :param x_support_set: A uint8 tensor of shape (b, num_classes, num_support_samples, h, w, c)
+        :param x_target_set: A uint8 tensor of shape (b, num_classes, num_target_samples, h, w, c)
+        :param rotations: A tensor of shape (b, num_classes) with the number of 90 degree rotations of each class
+        :return: The float support and target image tensors of shape (b, num_classes, num_samples, c, h, w), on the
+        preprocessor's device
+        """
+        num_support_samples = x_support_set.shape[2]
+        images = torch.cat((x_support_set, x_target_set), 2).to(device=self.device, non_blocking=True)
+        b, n, s, h, w, c = images.shape
 
-            transforms.ToTensor(), transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))])]
+        if self.reverse_channels is True:
+            images = images.flip(-1)
+        images = scale_raw_episode(images, dataset_name=self.dataset_name)
+        images = images.permute(0, 1, 2, 5, 3, 4).reshape(b * n, s, c, h, w)
+        # rotations are zeroed by the dataset when the episode is not augmented
+        images = apply_episode_transforms(images=images, k_list=rotations.reshape(-1).tolist(), augment_bool=True,
+                                          dataset_name=self.dataset_name)
+        images = images.view(b, n, s, c, h, w)
 
-    return transform_train, transform_evaluate
+        # the model flattens the class and sample dims of each set with a view, so the sets are returned contiguous
+        return images[:, :, :num_support_samples].contiguous(), images[:, :, num_support_samples:].contiguous()
 
 
 class FewShotLearningDatasetParallel(Dataset):
@@ -125,6 +211,12 @@ class FewShotLearningDatasetParallel(Dataset):
         self.data_path = args.dataset_path
         self.dataset_name = args.dataset_name
         self.data_loaded_in_memory = False
+        self.data_packed = args.packed_dataset
+        self.packed_images = dict()
+        self.shared_images = dict()
+        self.device_side_preprocessing = args.device_side_preprocessing
+        self.index_to_label_name = None
+        self.label_name_to_index = None
         self.image_height, self.image_width, self.image_channel = args.image_height, args.image_width, args.image_channels
         self.args = args
         self.indexes_of_folders_indicating_class = args.indexes_of_folders_indicating_class
@@ -215,27 +307,169 @@ class FewShotLearningDatasetParallel(Dataset):
                                      {class_key: data_image_paths[class_key] for class_key in x_test_classes},
             dataset_splits = {"train": x_train, "val":x_val , "test": x_test}
 
-        if self.args.load_into_memory is True:
+        if self.data_packed is True:
+            dataset_splits = self.load_packed_dataset(dataset_splits=dataset_splits)
+
+        elif self.args.load_into_memory is True:
 
             print("Loading data into RAM")
             x_loaded = {"train": [], "val": [], "test": []}
 
             for set_key, set_value in dataset_splits.items():
                 print("Currently loading into memory the {} set".format(set_key))
-                x_loaded[set_key] = {key: np.zeros(len(value), ) for key, value in set_value.items()}
-                # for class_key, class_value in set_value.items():
-                with tqdm.tqdm(total=len(set_value)) as pbar_memory_load:
-                    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-                        # Process the list of files, but split the work across the process pool to use all CPUs!
-                        for (class_label, class_images_loaded) in executor.map(self.load_parallel_batch, (set_value.items())):
-                            x_loaded[set_key][class_label] = class_images_loaded
-                            pbar_memory_load.update(1)
+                x_loaded[set_key] = self.load_into_shared_memory(set_name=set_key, set_value=set_value)
 
             dataset_splits = x_loaded
             self.data_loaded_in_memory = True
 
         return dataset_splits
 
+    def load_into_shared_memory(self, set_name, set_value):
+        """
+        Decodes every image of a set into a single contiguous shared-memory uint8 tensor of shape
+        (num_images, h, w, c). DataLoader workers receive a handle to that block rather than a copy of it, so the set is
+        held in RAM once regardless of the number of workers. Scaling to float is deferred to episode assembly.
+        :param set_name: The name of the set to load, e.g. "train", "val" etc.
+        :param set_value: dict containing class to filepath list pairs for this set
+        :return: dict containing class to row-index arrays into the shared-memory block of this set
+        """
+        num_images = int(np.sum([len(value) for value in set_value.values()]))
+        shared_images = None
+        shared_index = dict()
+        offset = 0
+        with tqdm.tqdm(total=len(set_value)) as pbar_memory_load:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=get_num_cpu_workers()) as executor:
+                # Process the list of files, but split the work across the process pool to use all CPUs!
+                for (class_label, class_images_loaded) in executor.map(self.load_raw_batch, (set_value.items())):
+                    if shared_images is None:
+                        shared_images = torch.empty((num_images,) + class_images_loaded.shape[1:],
+                                                    dtype=torch.uint8).share_memory_()
+                    shared_images[offset:offset + len(class_images_loaded)] = torch.from_numpy(class_images_loaded)
+                    shared_index[class_label] = np.arange(offset, offset + len(class_images_loaded))
+                    offset += len(class_images_loaded)
+                    pbar_memory_load.update(1)
+
+        self.shared_images[set_name] = shared_images
+        return shared_index
+
+    def get_packed_dataset_dir(self):
+        """
+        Returns the directory holding the packed copy of the dataset. The image shape is part of the directory name
+        such that changing the image size in the args does not serve stale packed images.
+        :return: The packed dataset directory
+        """
+        dataset_dir = os.environ['DATASET_DIR']
+        return "{}/{}_packed_{}x{}x{}".format(dataset_dir, self.dataset_name, self.image_height, self.image_width,
+                                              self.image_channel)
+
+    def load_packed_dataset(self, dataset_splits):
+        """
+        Replaces the class to filepath lists of every set with class to row-index arrays into a packed, memory-mapped
+        (num_images, h, w, c) uint8 file of that set. If the packed files are missing or do not match the current
+        splits, they are (re)built first through pack_dataset().
+        :param dataset_splits: dict containing set name to (class to filepath list) dictionaries
+        :return: dict containing set name to (class to packed row-index array) dictionaries
+        """
+        packed_dir = self.get_packed_dataset_dir()
+        packed_splits = dict()
+        for set_name, set_value in dataset_splits.items():
+            images_file = "{}/{}.npy".format(packed_dir, set_name)
+            index_file = "{}/{}_index.json".format(packed_dir, set_name)
+            expected_files = self.get_packed_file_signatures(set_value=set_value)
+
+            packed_index = None
+            if os.path.exists(index_file) and os.path.exists(images_file):
+                try:
+                    packed_index = self.load_from_json(filename=index_file)
+                except ValueError:
+                    packed_index = dict()
+                if packed_index.get('files') != expected_files:
+                    print("Packed {} set does not match the current split, repacking..".format(set_name))
+                    packed_index = None
+
+            if packed_index is None:
+                packed_index = self.pack_dataset(set_name=set_name, set_value=set_value, packed_dir=packed_dir)
+
+            packed_splits[set_name] = dict()
+            for class_label in set_value:
+                offset, count = packed_index['rows'][str(class_label)]
+                packed_splits[set_name][class_label] = np.arange(offset, offset + count)
+
+        return packed_splits
+
+    def get_packed_file_signatures(self, set_value):
+        """
+        Returns the [filepath, size, mtime] of every image of a set, class after class. A packed set is only reused
+        if these match the ones it was packed from, such that images replaced in place are repacked as well.
+        :param set_value: dict containing class to filepath list pairs for this set
+        :return: dict containing class (as stored in json) to list of [filepath, size, mtime] lists
+        """
+        return {str(class_label): [[filepath] + self.get_file_signature(filepath) for filepath in filepaths]
+                for class_label, filepaths in set_value.items()}
+
+    def pack_dataset(self, set_name, set_value, packed_dir):
+        """
+        Decodes every image of a set once and writes them into a single contiguous uint8 .npy file of shape
+        (num_images, h, w, c), alongside a json index mapping each class to its (offset, count) rows in that file and
+        to the signatures of the files it was packed from.
+        :param set_name: The name of the set to pack, e.g. "train", "val" etc.
+        :param set_value: dict containing class to filepath list pairs for this set
+        :param packed_dir: The directory to write the packed files into
+        :return: The index dict, holding the 'rows' and 'files' of each class
+        """
+        os.makedirs(packed_dir, exist_ok=True)
+        images_file = "{}/{}.npy".format(packed_dir, set_name)
+        index_file = "{}/{}_index.json".format(packed_dir, set_name)
+        tmp_images_file = "{}.tmp.npy".format(images_file[:-len(".npy")])
+
+        print("Packing the {} set into {}".format(set_name, images_file))
+        # the signatures are taken before decoding, such that a file changing while it is packed is repacked next time
+        packed_files = self.get_packed_file_signatures(set_value=set_value)
+        num_images = int(np.sum([len(value) for value in set_value.values()]))
+        packed_images = None
+        packed_rows = dict()
+        offset = 0
+        with tqdm.tqdm(total=len(set_value)) as pbar_pack:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=get_num_cpu_workers()) as executor:
+                for (class_label, class_images) in executor.map(self.load_raw_batch, (set_value.items())):
+                    if packed_images is None:
+                        packed_images = np.lib.format.open_memmap(tmp_images_file, mode='w+', dtype=np.uint8,
+                                                                  shape=(num_images,) + class_images.shape[1:])
+                    packed_images[offset:offset + len(class_images)] = class_images
+                    packed_rows[str(class_label)] = [offset, len(class_images)]
+                    offset += len(class_images)
+                    pbar_pack.update(1)
+
+        if packed_images is None:
+            # an empty split has no image to take the shape from
+            np.save(tmp_images_file, np.empty((0, self.image_height, self.image_width, self.image_channel), np.uint8))
+        else:
+            packed_images.flush()
+            del packed_images
+        os.replace(tmp_images_file, images_file)
+        packed_index = {'rows': packed_rows, 'files': packed_files}
+        self.save_to_json(dict_to_store=packed_index, filename=index_file)
+        self.packed_images.pop(set_name, None)
+
+        return packed_index
+
+    def get_packed_images(self, set_name):
+        """
+        Returns the memory-mapped packed images of a set. The file is opened lazily such that every DataLoader worker
+        maps the same page-cached file instead of receiving a pickled copy of it.
+        :param set_name: The name of the set, e.g. "train", "val" etc.
+        :return: A read-only memory-mapped uint8 array of shape (num_images, h, w, c)
+        """
+        if set_name not in self.packed_images:
+            self.packed_images[set_name] = np.load("{}/{}.npy".format(self.get_packed_dataset_dir(), set_name),
+                                                   mmap_mode='r')
+        return self.packed_images[set_name]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['packed_images'] = dict()
+        return state
+
     def load_datapaths(self):
         """
         If saved json dictionaries of the data are available, then this method loads the dictionaries such that the
@@ -250,6 +484,7 @@ class FewShotLearningDatasetParallel(Dataset):
         data_path_file = "{}/{}.json".format(dataset_dir, self.dataset_name)
         self.index_to_label_name_dict_file = "{}/map_to_label_name_{}.json".format(dataset_dir, self.dataset_name)
         self.label_name_to_map_dict_file = "{}/label_name_to_map_{}.json".format(dataset_dir, self.dataset_name)
+        self.file_index_file = "{}/{}_file_index.json".format(dataset_dir, self.dataset_name)
 
         if not os.path.exists(data_path_file):
             self.reset_stored_filepaths = True
@@ -263,6 +498,9 @@ class FewShotLearningDatasetParallel(Dataset):
             data_image_paths = self.load_from_json(filename=data_path_file)
             label_to_index = self.load_from_json(filename=self.label_name_to_map_dict_file)
             index_to_label_name_dict_file = self.load_from_json(filename=self.index_to_label_name_dict_file)
+            # keep the label maps in memory such that label lookups do not re-read the json files
+            self.index_to_label_name = index_to_label_name_dict_file
+            self.label_name_to_index = label_to_index
             return data_image_paths, index_to_label_name_dict_file, label_to_index
         except:
             print("Mapped data paths can't be found, remapping paths..")
@@ -315,6 +553,9 @@ class FewShotLearningDatasetParallel(Dataset):
         print("Get images from", self.data_path)
         data_image_path_list_raw = []
         labels = set()
+        file_index = self.load_file_index()
+        updated_file_index = dict()
+        files_to_test = []
         for subdir, dir, files in os.walk(self.data_path):
             for file in files:
                 if (".jpeg") in file.lower() or (".png") in file.lower() or (".jpg") in file.lower():
@@ -323,28 +564,66 @@ class FewShotLearningDatasetParallel(Dataset):
                     data_image_path_list_raw.append(filepath)
                     labels.add(label)
 
+                    # only files that are new or whose size/mtime changed since the last scan need to be tested
+                    file_signature = self.get_file_signature(filepath)
+                    if filepath in file_index and file_index[filepath][:2] == file_signature:
+                        updated_file_index[filepath] = file_index[filepath]
+                    else:
+                        updated_file_index[filepath] = file_signature + [False]
+                        files_to_test.append(filepath)
+
+        print("Testing {} new or changed images out of {}".format(len(files_to_test), len(data_image_path_list_raw)))
+        with tqdm.tqdm(total=len(files_to_test)) as pbar_error:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=get_num_cpu_workers()) as executor:
+                # Process the list of files, but split the work across the process pool to use all CPUs!
+                for filepath, image_file in zip(files_to_test, executor.map(self.load_test_image, files_to_test,
+                                                                            chunksize=64)):
+                    pbar_error.update(1)
+                    if image_file is not None:
+                        # testing may have fixed the file in place, so record its signature after the test
+                        updated_file_index[filepath] = self.get_file_signature(filepath) + [True]
+
+        self.save_to_json(dict_to_store=updated_file_index, filename=self.file_index_file)
+
         labels = sorted(labels)
         idx_to_label_name = {idx: label for idx, label in enumerate(labels)}
         label_name_to_idx = {label: idx for idx, label in enumerate(labels)}
         data_image_path_dict = {idx: [] for idx in list(idx_to_label_name.keys())}
-        with tqdm.tqdm(total=len(data_image_path_list_raw)) as pbar_error:
-            with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-                # Process the list of files, but split the work across the process pool to use all CPUs!
-                for image_file in executor.map(self.load_test_image, (data_image_path_list_raw)):
-                    pbar_error.update(1)
-                    if image_file is not None:
-                        label = self.get_label_from_path(image_file)
-                        data_image_path_dict[label_name_to_idx[label]].append(image_file)
+        for filepath in data_image_path_list_raw:
+            if updated_file_index[filepath][2]:
+                label = self.get_label_from_path(filepath)
+                data_image_path_dict[label_name_to_idx[label]].append(filepath)
 
         return data_image_path_dict, idx_to_label_name, label_name_to_idx
 
+    def get_file_signature(self, filepath):
+        """
+        Returns the [size, mtime] of a file, used to detect whether it changed since it was last tested.
+        :param filepath: The file's path
+        :return: A list containing the file's size in bytes and its modification time in nanoseconds
+        """
+        file_stat = os.stat(filepath)
+        return [file_stat.st_size, file_stat.st_mtime_ns]
+
+    def load_file_index(self):
+        """
+        Loads the persistent index of previously tested image files, mapping each filepath to [size, mtime, valid].
+        :return: The file index dict, empty if no index has been stored yet.
+        """
+        if not os.path.exists(self.file_index_file):
+            return dict()
+        try:
+            return self.load_from_json(filename=self.file_index_file)
+        except ValueError:
+            print("File index is corrupted, retesting all images..")
+            return dict()
+
     def get_label_set(self):
         """
         Generates a set containing all class numerical indexes
         :return: A set containing all class numerical indexes
         """
-        index_to_label_name_dict_file = self.load_from_json(filename=self.index_to_label_name_dict_file)
-        return set(list(index_to_label_name_dict_file.keys()))
+        return set(self.index_to_label_name.keys())
 
     def get_index_from_label(self, label):
         """
@@ -352,8 +631,7 @@ class FewShotLearningDatasetParallel(Dataset):
         :param label: A string of a human understandable class contained in the dataset
         :return: An int containing the numerical index of the given class-string
         """
-        label_to_index = self.load_from_json(filename=self.label_name_to_map_dict_file)
-        return label_to_index[label]
+        return self.label_name_to_index[label]
 
     def get_label_from_index(self, index):
         """
@@ -361,8 +639,7 @@ class FewShotLearningDatasetParallel(Dataset):
         :param index: A numerical index (int)
         :return: A human understandable label (str)
         """
-        index_to_label_name = self.load_from_json(filename=self.index_to_label_name_dict_file)
-        return index_to_label_name[index]
+        return self.index_to_label_name[index]
 
     def get_label_from_path(self, filepath):
         """
@@ -376,71 +653,34 @@ class FewShotLearningDatasetParallel(Dataset):
             label = int(label)
         return label
 
-    def load_image(self, image_path, channels):
+    def load_raw_image(self, image_path, channels):
         """
-        Given an image filepath and the number of channels to keep, load an image and keep the specified channels
+        Given an image filepath and the number of channels to keep, load and resize an image without any scaling
         :param image_path: The image's filepath
         :param channels: The number of channels to keep
-        :return: An image array of shape (h, w, channels), whose values range between 0.0 and 1.0.
-        """
-        if not self.data_loaded_in_memory:
-            image = Image.open(image_path)
-            if 'omniglot' in self.dataset_name:
-                image = image.resize((self.image_height, self.image_width), resample=Image.LANCZOS)
-                image = np.array(image, np.float32)
-                if channels == 1:
-                    image = np.expand_dims(image, axis=2)
-            else:
-                image = image.resize((self.image_height, self.image_width)).convert('RGB')
-                image = np.array(image, np.float32)
-                image = image / 255.0
-        else:
-            image = image_path
-
-        return image
-
-    def load_batch(self, batch_image_paths):
+        :return: A uint8 image array of shape (h, w, channels)
         """
-        Load a batch of images, given a list of filepaths
-        :param batch_image_paths: A list of filepaths
-        :return: A numpy array of images of shape batch, height, width, channels
-        """
-        image_batch = []
-
-        if self.data_loaded_in_memory:
-            for image_path in batch_image_paths:
-                image_batch.append(image_path)
-            image_batch = np.array(image_batch, dtype=np.float32)
-            #print(image_batch.shape)
+        image = Image.open(image_path)
+        if 'omniglot' in self.dataset_name:
+            image = image.resize((self.image_height, self.image_width), resample=Image.LANCZOS)
+            image = np.array(image, np.uint8)
+            if channels == 1:
+                image = np.expand_dims(image, axis=2)
         else:
-            image_batch = [self.load_image(image_path=image_path, channels=self.image_channel)
-                           for image_path in batch_image_paths]
-            image_batch = np.array(image_batch, dtype=np.float32)
-            image_batch = self.preprocess_data(image_batch)
+            image = image.resize((self.image_height, self.image_width)).convert('RGB')
+            image = np.array(image, np.uint8)
 
-        return image_batch
+        return image
 
-    def load_parallel_batch(self, inputs):
+    def load_raw_batch(self, inputs):
         """
-        Load a batch of images, given a list of filepaths
-        :param batch_image_paths: A list of filepaths
-        :return: A numpy array of images of shape batch, height, width, channels
+        Load a batch of raw uint8 images, given a class label and a list of filepaths
+        :param inputs: A tuple of the class label and its list of filepaths
+        :return: The class label and a uint8 numpy array of images of shape batch, height, width, channels
         """
         class_label, batch_image_paths = inputs
-        image_batch = []
-
-        if self.data_loaded_in_memory:
-            for image_path in batch_image_paths:
-                image_batch.append(np.copy(image_path))
-            image_batch = np.array(image_batch, dtype=np.float32)
-        else:
-            #with tqdm.tqdm(total=1) as load_pbar:
-            image_batch = [self.load_image(image_path=image_path, channels=self.image_channel)
-                           for image_path in batch_image_paths]
-                #load_pbar.update(1)
-
-            image_batch = np.array(image_batch, dtype=np.float32)
-            image_batch = self.preprocess_data(image_batch)
+        image_batch = np.array([self.load_raw_image(image_path=image_path, channels=self.image_channel)
+                                for image_path in batch_image_paths], dtype=np.uint8)
 
         return class_label, image_batch
 
@@ -450,14 +690,8 @@ class FewShotLearningDatasetParallel(Dataset):
         :param x: A data batch to preprocess
         :return: A preprocessed data batch
         """
-        x_shape = x.shape
-        x = np.reshape(x, (-1, x_shape[-3], x_shape[-2], x_shape[-1]))
         if self.reverse_channels is True:
-            reverse_photos = np.ones(shape=x.shape)
-            for channel in range(x.shape[-1]):
-                reverse_photos[:, :, :, x.shape[-1] - 1 - channel] = x[:, :, :, channel]
-            x = reverse_photos
-        x = x.reshape(x_shape)
+            x = np.ascontiguousarray(x[..., ::-1])
         return x
 
     def reconstruct_original(self, x):
@@ -480,11 +714,35 @@ class FewShotLearningDatasetParallel(Dataset):
         x = x[indices]
         return x
 
+    def load_episode_images(self, set_name, selected_classes, choose_samples_lists):
+        """
+        Reads all the raw images of an episode, class after class, with one indexed read where the storage allows it
+        :param set_name: The name of the set to use, e.g. "train", "val" etc.
+        :param selected_classes: The classes of the episode
+        :param choose_samples_lists: For each class, the indexes of its samples to read
+        :return: A uint8 numpy array of images of shape (num_classes * num_samples, h, w, c)
+        """
+        class_samples = [self.datasets[set_name][class_entry] for class_entry in selected_classes]
+
+        if self.data_packed or self.data_loaded_in_memory:
+            rows = np.concatenate([samples[choose_samples] for samples, choose_samples in
+                                   zip(class_samples, choose_samples_lists)])
+            if self.data_packed:
+                return self.get_packed_images(set_name)[rows]
+            return self.shared_images[set_name].numpy()[rows]
+
+        _, image_batch = self.load_raw_batch((None, [samples[sample] for samples, choose_samples in
+                                                     zip(class_samples, choose_samples_lists)
+                                                     for sample in choose_samples]))
+        return image_batch
+
     def get_set(self, dataset_name, seed, augment_images=False):
         """
         Generates a task-set to be used for training or evaluation
         :param set_name: The name of the set to use, e.g. "train", "val" etc.
-        :return: A task-set containing an image and label support set, and an image and label target set.
+        :return: A task-set containing an image and label support set, and an image and label target set. With
+        device_side_preprocessing the images are raw uint8 (num_classes, num_samples, h, w, c) arrays and the
+        per-class rotations to apply are returned as well.
         """
         #seed = seed % self.args.total_unique_tasks
         rng = np.random.RandomState(seed)
@@ -492,40 +750,33 @@ class FewShotLearningDatasetParallel(Dataset):
                                       size=self.num_classes_per_set, replace=False)
         rng.shuffle(selected_classes)
         k_list = rng.randint(0, 4, size=self.num_classes_per_set)
-        k_dict = {selected_class: k_item for (selected_class, k_item) in zip(selected_classes, k_list)}
-        episode_labels = [i for i in range(self.num_classes_per_set)]
-        class_to_episode_label = {selected_class: episode_label for (selected_class, episode_label) in
-                                  zip(selected_classes, episode_labels)}
-
-        x_images = []
-        y_labels = []
-
-        for class_entry in selected_classes:
-            choose_samples_list = rng.choice(self.dataset_size_dict[dataset_name][class_entry],
-                                             size=self.num_samples_per_class + self.num_target_samples, replace=False)
-            class_image_samples = []
-            class_labels = []
-            for sample in choose_samples_list:
-                choose_samples = self.datasets[dataset_name][class_entry][sample]
-                x_class_data = self.load_batch([choose_samples])[0]
-                k = k_dict[class_entry]
-                x_class_data = augment_image(image=x_class_data, k=k,
-                                             channels=self.image_channel, augment_bool=augment_images,
-                                             dataset_name=self.dataset_name, args=self.args)
-                class_image_samples.append(x_class_data)
-                class_labels.append(int(class_to_episode_label[class_entry]))
-            class_image_samples = torch.stack(class_image_samples)
-            x_images.append(class_image_samples)
-            y_labels.append(class_labels)
-
-        x_images = torch.stack(x_images)
-        y_labels = np.array(y_labels, dtype=np.float32)
+        num_samples = self.num_samples_per_class + self.num_target_samples
+
+        # episode label i is given to the i-th selected class
+        choose_samples_lists = [rng.choice(self.dataset_size_dict[dataset_name][class_entry], size=num_samples,
+                                           replace=False) for class_entry in selected_classes]
+
+        x_images = self.load_episode_images(set_name=dataset_name, selected_classes=selected_classes,
+                                            choose_samples_lists=choose_samples_lists)
+        x_images = x_images.reshape((self.num_classes_per_set, num_samples) + x_images.shape[1:])
+        y_labels = np.repeat(np.arange(self.num_classes_per_set, dtype=np.float32)[:, None], num_samples, axis=1)
+
+        if self.device_side_preprocessing:
+            x_images = torch.from_numpy(np.ascontiguousarray(x_images))
+            rotations = k_list if augment_images is True else np.zeros_like(k_list)
+        else:
+            x_images = self.preprocess_data(x_images)
+            x_images = augment_episode(images=x_images, k_list=k_list, augment_bool=augment_images,
+                                       dataset_name=self.dataset_name)
 
         support_set_images = x_images[:, :self.num_samples_per_class]
         support_set_labels = y_labels[:, :self.num_samples_per_class]
         target_set_images = x_images[:, self.num_samples_per_class:]
         target_set_labels = y_labels[:, self.num_samples_per_class:]
 
+        if self.device_side_preprocessing:
+            return support_set_images, target_set_images, support_set_labels, target_set_labels, seed, rotations
+
         return support_set_images, target_set_images, support_set_labels, target_set_labels, seed
 
     def __len__(self):
@@ -548,16 +799,99 @@ class FewShotLearningDatasetParallel(Dataset):
         self.seed[dataset_name] = seed
 
     def __getitem__(self, idx):
-        support_set_images, target_set_image, support_set_labels, target_set_label, seed = \
-            self.get_set(self.current_set_name, seed=self.seed[self.current_set_name] + idx,
-                         augment_images=self.augment_images)
+        if isinstance(idx, tuple):
+            # (set_name, seed, augment_images) task descriptions are produced by a TaskSetSampler, such that
+            # long-lived workers do not depend on their (stale) copy of the set/seed state
+            set_name, seed, augment_images = idx
+        else:
+            set_name, seed, augment_images = self.current_set_name, self.seed[self.current_set_name] + idx, \
+                                             self.augment_images
 
-        return support_set_images, target_set_image, support_set_labels, target_set_label, seed
+        return self.get_set(set_name, seed=seed, augment_images=augment_images)
 
     def reset_seed(self):
         self.seed = self.init_seed
 
 
+class DevicePrefetcher(object):
+    def __init__(self, batches, device, num_tensors_to_transfer=4):
+        """
+        Wraps an iterable of batches and copies them to the device ahead of time. On CUDA devices, the copy of batch
+        N+1 is issued on a side stream (from pinned memory, without blocking) while batch N is being consumed. On the
+        CPU the batches are handed over as they are, without any copy.
+        :param batches: An iterable of batch tuples, e.g. a DataLoader
+        :param device: The device to transfer the batches to
+        :param num_tensors_to_transfer: The number of leading batch entries to transfer, the remaining entries (e.g.
+        the seeds) stay on the host.
+        """
+        self.batches = batches
+        self.device = torch.device(device)
+        self.num_tensors_to_transfer = num_tensors_to_transfer
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+
+    def transfer(self, batch):
+        with torch.cuda.stream(self.stream):
+            return tuple(item.to(device=self.device, non_blocking=True) if idx < self.num_tensors_to_transfer
+                         else item for idx, item in enumerate(batch))
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.batches:
+                yield batch
+            return
+
+        batches = iter(self.batches)
+        next_batch = next(batches, None)
+        if next_batch is not None:
+            next_batch = self.transfer(next_batch)
+
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(device=self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            for item in batch[:self.num_tensors_to_transfer]:
+                # the tensors were allocated on the side stream, make sure their memory is not reused too early
+                item.record_stream(current_stream)
+
+            next_batch = next(batches, None)
+            if next_batch is not None:
+                next_batch = self.transfer(next_batch)
+
+            yield batch
+
+
+class TaskSetSampler(Sampler):
+    def __init__(self, set_name):
+        """
+        A sampler that yields full task descriptions (set_name, seed, augment_images) instead of plain indexes. This
+        lets a DataLoader with persistent workers switch seeds and augmentation between iterations, since the sampler
+        lives in the main process while the workers keep their own copy of the dataset.
+        :param set_name: The name of the set to sample tasks from, e.g. "train", "val" etc.
+        """
+        self.set_name = set_name
+        self.seed = 0
+        self.num_tasks = 0
+        self.augment_images = False
+
+    def set_tasks(self, seed, num_tasks, augment_images):
+        """
+        Sets the tasks the next iteration over the sampler will produce.
+        :param seed: The seed of the first task, task idx uses seed + idx.
+        :param num_tasks: The number of tasks to produce.
+        :param augment_images: Whether the images of the tasks should be augmented.
+        """
+        self.seed = seed
+        self.num_tasks = num_tasks
+        self.augment_images = augment_images
+
+    def __iter__(self):
+        for idx in range(self.num_tasks):
+            yield self.set_name, self.seed + idx, self.augment_images
+
+    def __len__(self):
+        return self.num_tasks
+
+
 class MetaLearningSystemDataLoader(object):
     def __init__(self, args, current_iter=0):
         """
@@ -571,10 +905,21 @@ class MetaLearningSystemDataLoader(object):
         self.batch_size = args.batch_size
         self.samples_per_iter = args.samples_per_iter
         self.num_workers = args.num_dataprovider_workers
+        self.persistent_workers = args.persistent_dataloader_workers
+        self.persistent_dataloaders = dict()
         self.total_train_iters_produced = 0
         self.dataset = FewShotLearningDatasetParallel(args=args)
         self.batches_per_iter = args.samples_per_iter
         self.full_data_length = self.dataset.data_length
+        self.device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() \
+            else torch.device('cpu')
+        self.prefetch_to_device = args.prefetch_to_device
+        self.pin_memory = self.prefetch_to_device and self.device.type == 'cuda'
+        self.device_episode_preprocessor = None
+        if args.device_side_preprocessing:
+            self.device_episode_preprocessor = DeviceEpisodePreprocessor(dataset_name=args.dataset_name,
+                                                                         reverse_channels=args.reverse_channels,
+                                                                         device=self.device)
         self.continue_from_iter(current_iter=current_iter)
         self.args = args
 
@@ -583,8 +928,56 @@ class MetaLearningSystemDataLoader(object):
         Returns a data loader with the correct set (train, val or test), continuing from the current iter.
         :return:
         """
+        if self.persistent_workers:
+            return self.get_persistent_dataloader()
+
         return DataLoader(self.dataset, batch_size=(self.num_of_gpus * self.batch_size * self.samples_per_iter),
-                          shuffle=False, num_workers=self.num_workers, drop_last=True)
+                          shuffle=False, num_workers=self.num_workers, drop_last=True, pin_memory=self.pin_memory)
+
+    def get_batches(self):
+        """
+        Returns the batches of the current set, prefetched to the device if enabled.
+        :return:
+        """
+        if self.prefetch_to_device:
+            return DevicePrefetcher(batches=self.get_dataloader(), device=self.device)
+
+        return self.get_dataloader()
+
+    def get_persistent_dataloader(self):
+        """
+        Returns the long-lived data loader of the current set, creating it on first use. Its workers are started (and
+        the dataset is pickled to them) only once per run, the seed and augmentation of the current set are sent to
+        them through the loader's TaskSetSampler.
+        :return:
+        """
+        set_name = self.dataset.current_set_name
+        if set_name not in self.persistent_dataloaders:
+            self.persistent_dataloaders[set_name] = DataLoader(
+                self.dataset, batch_size=(self.num_of_gpus * self.batch_size * self.samples_per_iter),
+                sampler=TaskSetSampler(set_name=set_name), num_workers=self.num_workers, drop_last=True,
+                persistent_workers=self.num_workers > 0, pin_memory=self.pin_memory)
+
+        dataloader = self.persistent_dataloaders[set_name]
+        dataloader.sampler.set_tasks(seed=self.dataset.seed[set_name], num_tasks=len(self.dataset),
+                                     augment_images=self.dataset.augment_images)
+        return dataloader
+
+    def preprocess_batch(self, sample_batched):
+        """
+        Runs the device-side episode preprocessing stage on a batch, if enabled, such that every batch handed out has
+        the same (x_support_set, x_target_set, y_support_set, y_target_set, seed) form.
+        :param sample_batched: A batch as produced by the DataLoader
+        :return: The preprocessed batch
+        """
+        if self.device_episode_preprocessor is None:
+            return sample_batched
+
+        x_support_set, x_target_set, y_support_set, y_target_set, seed, rotations = sample_batched
+        x_support_set, x_target_set = self.device_episode_preprocessor(x_support_set=x_support_set,
+                                                                       x_target_set=x_target_set,
+                                                                       rotations=rotations)
+        return x_support_set, x_target_set, y_support_set, y_target_set, seed
 
     def continue_from_iter(self, current_iter):
         """
@@ -606,8 +999,8 @@ class MetaLearningSystemDataLoader(object):
         self.dataset.switch_set(set_name="train", current_iter=self.total_train_iters_produced)
         self.dataset.set_augmentation(augment_images=augment_images)
         self.total_train_iters_produced += (self.num_of_gpus * self.batch_size * self.samples_per_iter)
-        for sample_id, sample_batched in enumerate(self.get_dataloader()):
-            yield sample_batched
+        for sample_id, sample_batched in enumerate(self.get_batches()):
+            yield self.preprocess_batch(sample_batched)
 
 
     def get_val_batches(self, total_batches=-1, augment_images=False):
@@ -622,8 +1015,8 @@ class MetaLearningSystemDataLoader(object):
             self.dataset.data_length['val'] = total_batches * self.dataset.batch_size
         self.dataset.switch_set(set_name="val")
         self.dataset.set_augmentation(augment_images=augment_images)
-        for sample_id, sample_batched in enumerate(self.get_dataloader()):
-            yield sample_batched
+        for sample_id, sample_batched in enumerate(self.get_batches()):
+            yield self.preprocess_batch(sample_batched)
 
 
     def get_test_batches(self, total_batches=-1, augment_images=False):
@@ -638,6 +1031,6 @@ class MetaLearningSystemDataLoader(object):
             self.dataset.data_length['test'] = total_batches * self.dataset.batch_size
         self.dataset.switch_set(set_name='test')
         self.dataset.set_augmentation(augment_images=augment_images)
-        for sample_id, sample_batched in enumerate(self.get_dataloader()):
-            yield sample_batched
+        for sample_id, sample_batched in enumerate(self.get_batches()):
+            yield self.preprocess_batch(sample_batched)
 
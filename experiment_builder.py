@@ -280,7 +280,7 @@ class ExperimentBuilder(object):
                         self.data.get_test_batches(total_batches=int(self.args.num_evaluation_tasks / self.args.batch_size),
                                                    augment_images=False)):
                     #print(test_sample[4])
-                    per_model_per_batch_targets[idx].extend(np.array(test_sample[3]))
+                    per_model_per_batch_targets[idx].extend(np.array(torch.as_tensor(test_sample[3]).cpu()))
                     per_model_per_batch_preds = self.test_evaluation_iteration(val_sample=test_sample,
                                                                                sample_idx=sample_idx,
                                                                                model_idx=idx,
@@ -1,12 +1,17 @@
+import contextlib
+import math
 import os
+import warnings
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.utils.checkpoint import checkpoint
 
-from meta_neural_network_architectures import VGGReLUNormNetwork, ResNet12, MetaLossNetwork, LossAdapter
+from meta_neural_network_architectures import VGGReLUNormNetwork, ResNet12, MetaLossNetwork, LossAdapter, \
+    MetaDataParallel, MetaBatchNormLayer
 from inner_loop_optimizers import LSLRGradientDescentLearningRule
 
 
@@ -23,6 +28,60 @@ def set_torch_seed(seed):
     return rng
 
 
+class PreservedBatchNormStatistics(object):
+    def __init__(self, network):
+        """
+        A context that restores the running statistics (and their backups) of the batch norm layers of a network to
+        their values on entering it.
+        :param network: The network whose batch norm layers to restore.
+        """
+        self.statistics = [(module, name) for module in network.modules() if isinstance(module, MetaBatchNormLayer)
+                           for name in ('running_mean', 'running_var', 'backup_running_mean', 'backup_running_var')]
+        self.saved_statistics = None
+
+    def __enter__(self):
+        self.saved_statistics = [getattr(module, name).data.clone() for module, name in self.statistics]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for (module, name), saved_statistic in zip(self.statistics, self.saved_statistics):
+            getattr(module, name).data = saved_statistic
+
+
+class HostSyncCounter(object):
+    def __init__(self, device, enabled=True):
+        """
+        A context that counts the operations that synchronize the host with a cuda device while it is active, using
+        torch's sync debug mode. Nothing is counted on other devices, as they never need to be synchronized.
+        :param device: The device the model runs on.
+        :param enabled: Whether to count the synchronizations at all.
+        """
+        self.enabled = enabled and torch.device(device).type == 'cuda'
+        self.count = 0
+        self.previous_mode = None
+        self.recorded_warnings = None
+        self.records = None
+
+    def __enter__(self):
+        self.count = 0
+        if self.enabled:
+            self.previous_mode = torch.cuda.get_sync_debug_mode()
+            self.recorded_warnings = warnings.catch_warnings(record=True)
+            self.records = self.recorded_warnings.__enter__()
+            warnings.simplefilter('always')
+            torch.cuda.set_sync_debug_mode('warn')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.enabled:
+            torch.cuda.set_sync_debug_mode(self.previous_mode)
+            self.recorded_warnings.__exit__(exc_type, exc_value, traceback)
+            for record in self.records:
+                if 'synchronizing CUDA operation' in str(record.message):
+                    self.count += 1
+                else:
+                    warnings.warn_explicit(record.message, record.category, record.filename, record.lineno)
+
+
 class MAMLFewShotClassifier(nn.Module):
     def __init__(self, im_shape, device, args):
         """
@@ -61,6 +120,7 @@ class MAMLFewShotClassifier(nn.Module):
                                                                     alfa=self.args.alfa, random_init=self.args.random_init)
 
         names_weights_copy = self.get_inner_loop_parameter_dict(self.classifier.named_parameters())
+        self.classifier.set_fast_weight_names(list(names_weights_copy.keys()))
 
         if self.args.meta_loss:
 
@@ -114,12 +174,38 @@ class MAMLFewShotClassifier(nn.Module):
             print(torch.cuda.device_count())
             if torch.cuda.device_count() > 1:
                 self.to(torch.cuda.current_device())
-                self.classifier = nn.DataParallel(module=self.classifier)
+                self.classifier = MetaDataParallel(module=self.classifier)
             else:
                 self.to(torch.cuda.current_device())
 
             self.device = torch.cuda.current_device()
 
+        # with mixed precision only the backbone runs under autocast, while the parameters, the fast weights and their
+        # updates stay in full precision. float16 also needs its losses scaled, in the inner loop as well as the outer
+        self.autocast_dtype = getattr(torch, self.args.mixed_precision_dtype)
+        self.grad_scaler = torch.amp.GradScaler(torch.device(self.device).type,
+                                                enabled=self.autocast_dtype == torch.float16)
+        if self.args.channels_last:
+            self.classifier.to(memory_format=torch.channels_last)
+
+        # the compiled networks are kept out of the module tree, so that they don't show up in the state dict. A graph
+        # compiled by torch.compile can't be differentiated twice, so they only run the passes that are differentiated
+        # once (first order inner loops and evaluation), and are recompiled for every inner loop step and input shape
+        self.compiled_networks = dict()
+        self.use_compiled_networks = False
+        if self.args.compile_backbone:
+            num_steps = max(self.args.number_of_training_steps_per_iter, self.args.number_of_evaluation_steps_per_iter)
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 4 * (num_steps + 1))
+            # the memory layout is left as chosen by channels_last, instead of letting inductor convert it
+            compile_options = {'layout_optimization': False}
+            self.compiled_networks['classifier'] = torch.compile(self.classifier, dynamic=False,
+                                                                 options=compile_options)
+            if self.args.meta_loss:
+                self.compiled_networks['meta_loss'] = torch.compile(self.meta_loss, dynamic=False,
+                                                                    options=compile_options)
+                self.compiled_networks['meta_query_loss'] = torch.compile(self.meta_query_loss, dynamic=False,
+                                                                          options=compile_options)
+
     def get_per_step_loss_importance_vector(self):
         """
         Generates a tensor of dimensionality (num_inner_loop_steps) indicating the importance of each step's target
@@ -127,19 +213,18 @@ class MAMLFewShotClassifier(nn.Module):
         :return: A tensor to be used to compute the weighted average of the loss, useful for
         the MSL (Multi Step Loss) mechanism.
         """
-        loss_weights = np.ones(shape=(self.args.number_of_training_steps_per_iter)) * (
-                1.0 / self.args.number_of_training_steps_per_iter)
+        initial_value = 1.0 / self.args.number_of_training_steps_per_iter
         decay_rate = 1.0 / self.args.number_of_training_steps_per_iter / self.args.multi_step_loss_num_epochs
         min_value_for_non_final_losses = 0.03 / self.args.number_of_training_steps_per_iter
-        for i in range(len(loss_weights) - 1):
-            curr_value = np.maximum(loss_weights[i] - (self.current_epoch * decay_rate), min_value_for_non_final_losses)
-            loss_weights[i] = curr_value
+        curr_value = max(initial_value - (self.current_epoch * decay_rate), min_value_for_non_final_losses)
+
+        # the weights are filled in on the device, as copying them from the host would block until it is idle
+        loss_weights = torch.full((self.args.number_of_training_steps_per_iter,), curr_value, device=self.device)
 
-        curr_value = np.minimum(
-            loss_weights[-1] + (self.current_epoch * (self.args.number_of_training_steps_per_iter - 1) * decay_rate),
+        curr_value = min(
+            initial_value + (self.current_epoch * (self.args.number_of_training_steps_per_iter - 1) * decay_rate),
             1.0 - ((self.args.number_of_training_steps_per_iter - 1) * min_value_for_non_final_losses))
         loss_weights[-1] = curr_value
-        loss_weights = torch.Tensor(loss_weights).to(device=self.device)
         return loss_weights
 
     def get_inner_loop_parameter_dict(self, params):
@@ -159,34 +244,49 @@ class MAMLFewShotClassifier(nn.Module):
 
         return param_dict
 
-    def apply_inner_loop_update(self, loss, names_weights_copy, generated_alpha_params, generated_beta_params, use_second_order, current_step_idx, grads=None):
+    def get_inner_loop_gradients(self, loss, weights, **kwargs):
+        """
+        Computes the gradients of an inner loop loss w.r.t. the fast weights with torch.autograd.grad. When the backbone
+        runs in float16, the loss is multiplied by the current loss scale of the outer loop before it is differentiated
+        and the gradients are divided by it after, so that small gradients don't flush to zero in the half precision
+        backward pass. The scale is a constant of the graph, so the gradients stay exact when they are differentiated
+        again (create_graph), and it adapts along with the outer loop's, as an overflow in the inner loop makes the
+        outer loop gradients non-finite too.
+        :param loss: A scalar inner loop loss.
+        :param weights: The fast weights to differentiate w.r.t.
+        :param kwargs: Any other arguments of torch.autograd.grad.
+        :return: A tuple with the gradient of every fast weight.
+        """
+        if not self.grad_scaler.is_enabled():
+            return torch.autograd.grad(loss, weights, **kwargs)
+
+        loss_scale = self.grad_scaler.scale(torch.ones((), device=loss.device))
+        grads = torch.autograd.grad(loss * loss_scale, weights, **kwargs)
+        return tuple(None if grad is None else grad / loss_scale for grad in grads)
+
+    def apply_inner_loop_update(self, loss, names_weights_copy, generated_alpha_params, generated_beta_params, use_second_order, current_step_idx, grads=None, retain_graph=False):
         """
         Applies an inner loop update given current step's loss, the weights to update, a flag indicating whether to use
         second order derivatives and the current step's index.
         :param loss: Current step's loss with respect to the support set.
         :param names_weights_copy: A dictionary with names to parameters to update.
+        :param generated_alpha_params: The learning rate multipliers generated by ALFA, of shape num_tasks, num_layers.
+        :param generated_beta_params: The weight decay multipliers generated by ALFA, of shape num_tasks, num_layers.
         :param use_second_order: A boolean flag of whether to use second order derivatives.
         :param current_step_idx: Current step's index.
+        :param retain_graph: Whether the graph of the loss is still needed afterwards (e.g. by a target loss).
         :return: A dictionary with the updated weights (name, param)
         """
-        num_gpus = torch.cuda.device_count()
-        if num_gpus > 1:
-            self.classifier.module.zero_grad(params=names_weights_copy)
-        else:
-            self.classifier.zero_grad(params=names_weights_copy)
-
+        # autograd.grad never accumulates into .grad, so there are no gradients of the fast weights to zero here
         if grads is None:
-            grads = torch.autograd.grad(loss, names_weights_copy.values(),
-                                        create_graph=use_second_order, allow_unused=True)
+            grads = self.get_inner_loop_gradients(loss, names_weights_copy.values(), create_graph=use_second_order,
+                                                  retain_graph=use_second_order or retain_graph, allow_unused=True)
 
         names_grads_copy = dict(zip(names_weights_copy.keys(), grads))
 
-        names_weights_copy = {key: value[0] for key, value in names_weights_copy.items()}
-
         for key, grad in names_grads_copy.items():
             if grad is None:
                 print('Grads not found for inner loop parameter', key)
-            names_grads_copy[key] = names_grads_copy[key].sum(dim=0)
 
 
         names_weights_copy = self.inner_loop_optimizer.update_params(names_weights_dict=names_weights_copy,
@@ -195,23 +295,243 @@ class MAMLFewShotClassifier(nn.Module):
                                                                      generated_beta_params=generated_beta_params,
                                                                      num_step=current_step_idx)
 
-        num_devices = torch.cuda.device_count() if torch.cuda.is_available() else 1
-        names_weights_copy = {
-            name.replace('module.', ''): value.unsqueeze(0).repeat(
-                [num_devices] + [1 for i in range(len(value.shape))]) for
-            name, value in names_weights_copy.items()}
+        return names_weights_copy
+
+    def inner_loop_step(self, names_weights_copy, logits, x_support_set_task, y_support_set_task,
+                        y_support_set_one_hot, x_target_set_task, names_loss_weights_copy,
+                        names_query_loss_weights_copy, use_second_order, num_step, proximal_weights=None):
+        """
+        Takes a single inner loop step: computes the (meta) loss of the support set with the current fast weights and
+        applies the inner loop update to them.
+        :param names_weights_copy: A dictionary with the current fast weights, of shape num_tasks, ...
+        :param logits: The output of classifier_forward for the current fast weights, if it has already been computed.
+        :param x_support_set_task: The support images, of shape num_tasks, b, c, h, w
+        :param y_support_set_task: The support targets, of shape num_tasks, b
+        :param y_support_set_one_hot: The one-hot support targets, of shape num_tasks, b, num_classes
+        :param x_target_set_task: The target images, of shape num_tasks, b_t, c, h, w
+        :param names_loss_weights_copy: A dictionary with the weights of the support set meta-loss network.
+        :param names_query_loss_weights_copy: A dictionary with the weights of the query set meta-loss network.
+        :param use_second_order: A boolean flag of whether to use second order derivatives.
+        :param num_step: An integer indicating the number of the step in the inner loop.
+        :param proximal_weights: A dictionary with the weights the fast weights are regularized towards, if any.
+        :return: A dictionary with the updated fast weights (name, param)
+        """
+        num_tasks = x_support_set_task.shape[0]
+        logits_are_shared = logits is not None
+        if logits is None:
+            logits = self.classifier_forward(x=x_support_set_task, x_t=x_target_set_task,
+                                             weights=names_weights_copy,
+                                             backup_running_statistics=True if (num_step == 0) else False,
+                                             training=True, num_step=num_step)
+
+        meta_loss, support_preds, support_loss = self.net_forward(x=x_support_set_task,
+                                                       y=y_support_set_task,
+                                                       y_one_hot=y_support_set_one_hot,
+                                                       weights=names_weights_copy,
+                                                       backup_running_statistics=
+                                                       True if (num_step == 0) else False,
+                                                       training=True, num_step=num_step,
+                                                       x_t=x_target_set_task,
+                                                       meta_loss_weights=names_loss_weights_copy,
+                                                       meta_query_loss_weights=names_query_loss_weights_copy,
+                                                       logits=logits)
+        inner_loss = meta_loss.sum()
+        if proximal_weights is not None:
+            inner_loss = inner_loss + self.get_proximal_regularization(names_weights_copy, proximal_weights).sum()
+
+        generated_alpha_params = None
+        generated_beta_params = None
+
+        loss_grads = None
 
+        if self.args.alfa:
 
-        return names_weights_copy
+            loss_grads = self.get_inner_loop_gradients(inner_loss, names_weights_copy.values(),
+                                                       create_graph=use_second_order,
+                                                       retain_graph=use_second_order or logits_are_shared)
+            per_step_task_embedding = torch.cat((
+                self.get_per_task_means(names_weights_copy.values(), num_tasks),
+                self.get_per_task_means(loss_grads, num_tasks)), dim=1)
+
+            generated_params = self.update_rule_learner(per_step_task_embedding)
+            num_layers = len(names_weights_copy)
+
+            generated_alpha_params, generated_beta_params = torch.split(generated_params,
+                                                                        split_size_or_sections=num_layers, dim=1)
+
+        return self.apply_inner_loop_update(loss=inner_loss,
+                                            names_weights_copy=names_weights_copy,
+                                            generated_beta_params=generated_beta_params,
+                                            generated_alpha_params=generated_alpha_params,
+                                            use_second_order=use_second_order,
+                                            current_step_idx=num_step,
+                                            grads=loss_grads,
+                                            retain_graph=logits_are_shared)
+
+    def get_proximal_regularization(self, names_weights_copy, proximal_weights):
+        """
+        Computes the proximal term lambda / 2 * ||fast weights - proximal weights||^2 that keeps the inner loop
+        solution of the implicit meta-gradient close to the meta-parameters.
+        :param names_weights_copy: A dictionary with the fast weights, of shape num_tasks, ...
+        :param proximal_weights: A dictionary with the weights to regularize towards, of shape num_tasks, ...
+        :return: The per task regularization, of shape num_tasks
+        """
+        num_tasks = next(iter(names_weights_copy.values())).shape[0]
+        squared_distance = sum((value - proximal_weights[key]).pow(2).reshape(num_tasks, -1).sum(dim=1)
+                               for key, value in names_weights_copy.items())
+        return 0.5 * self.args.implicit_gradient_lambda * squared_distance
+
+    def get_implicit_target_loss(self, names_weights_copy, meta_weights, x_support_set_task, y_support_set_task,
+                                 y_support_set_one_hot, x_target_set_task, y_target_set_task, names_loss_weights_copy,
+                                 names_query_loss_weights_copy, num_step):
+        """
+        Computes the target loss of the adapted fast weights. Its value is the usual target loss, but its gradient with
+        respect to the meta-parameters is the implicit meta-gradient of iMAML (Rajeswaran et al., 2019) instead of the
+        gradient through the unrolled inner loop. With lambda the proximal regularization strength, H the hessian of
+        the inner loop loss and g the gradient of the target loss at the adapted weights, x = (I + H / lambda)^-1 g is
+        the meta-gradient of the initialization, and -x . d(grad inner loop loss) / lambda that of every other
+        meta-parameter the inner loop loss depends on (e.g. the meta-loss networks).
+        :param names_weights_copy: A dictionary with the adapted fast weights, leaves of shape num_tasks, ...
+        :param meta_weights: A dictionary with the meta-parameters the inner loop started from, of shape num_tasks, ...
+        :param x_support_set_task: The support images, of shape num_tasks, b, c, h, w
+        :param y_support_set_task: The support targets, of shape num_tasks, b
+        :param y_support_set_one_hot: The one-hot support targets, of shape num_tasks, b, num_classes
+        :param x_target_set_task: The target images, of shape num_tasks, b_t, c, h, w
+        :param y_target_set_task: The target targets, of shape num_tasks, b_t
+        :param names_loss_weights_copy: A dictionary with the weights of the support set meta-loss network.
+        :param names_query_loss_weights_copy: A dictionary with the weights of the query set meta-loss network.
+        :param num_step: The index of the last inner loop step, whose loss defines the inner loop objective.
+        :return: The per task target losses and the target predictions.
+        """
+        num_tasks = x_support_set_task.shape[0]
+        fast_weights = list(names_weights_copy.values())
+        logits = self.classifier_forward(x=x_support_set_task, x_t=x_target_set_task, weights=names_weights_copy,
+                                         backup_running_statistics=False, training=True, num_step=num_step)
+        target_loss, target_preds, _ = self.net_forward(x=x_support_set_task, y=y_support_set_task,
+                                                        weights=names_weights_copy, backup_running_statistics=False,
+                                                        training=True, num_step=num_step, x_t=x_target_set_task,
+                                                        y_t=y_target_set_task, logits=logits)
+        inner_loss, _, _ = self.net_forward(x=x_support_set_task, y=y_support_set_task, y_one_hot=y_support_set_one_hot,
+                                            weights=names_weights_copy,
+                                            backup_running_statistics=False, training=True, num_step=num_step,
+                                            x_t=x_target_set_task, meta_loss_weights=names_loss_weights_copy,
+                                            meta_query_loss_weights=names_query_loss_weights_copy, logits=logits)
+
+        target_loss_grads = self.get_inner_loop_gradients(target_loss.sum(), fast_weights, retain_graph=True)
+        inner_loss_grads = self.get_inner_loop_gradients(inner_loss.sum(), fast_weights, create_graph=True)
+        implicit_grads = self.solve_implicit_meta_gradient(inner_loss_grads=inner_loss_grads,
+                                                           fast_weights=fast_weights,
+                                                           target_loss_grads=target_loss_grads)
+
+        implicit_loss = sum(((meta_weight - inner_loss_grad / self.args.implicit_gradient_lambda) *
+                             implicit_grad).reshape(num_tasks, -1).sum(dim=1) for meta_weight, inner_loss_grad, implicit_grad
+                            in zip(meta_weights.values(), inner_loss_grads, implicit_grads))
+
+        return target_loss + implicit_loss - implicit_loss.detach(), target_preds
+
+    def solve_implicit_meta_gradient(self, inner_loss_grads, fast_weights, target_loss_grads):
+        """
+        Solves (I + H / lambda) x = g for x with a few steps of conjugate gradient, separately for every task, where H
+        is the hessian of the inner loop loss at the adapted fast weights, which is only accessed through
+        hessian-vector products.
+        :param inner_loss_grads: The gradients of the inner loop loss w.r.t. the fast weights, with their graph.
+        :param fast_weights: The adapted fast weights, of shape num_tasks, ...
+        :param target_loss_grads: The gradients g of the target loss w.r.t. the fast weights.
+        :return: A list with the solution x for every fast weight.
+        """
+        num_tasks = fast_weights[0].shape[0]
+
+        def task_dot(a, b):
+            return sum((a_i * b_i).reshape(num_tasks, -1).sum(dim=1) for a_i, b_i in zip(a, b))
+
+        def task_scale(scale, tensor):
+            return scale.view([num_tasks] + [1] * (tensor.dim() - 1)) * tensor
+
+        def matrix_vector_product(v):
+            hessian_vector_products = torch.autograd.grad(inner_loss_grads, fast_weights, grad_outputs=v,
+                                                          retain_graph=True, allow_unused=True)
+            return [v_i + (hv_i / self.args.implicit_gradient_lambda if hv_i is not None else 0)
+                    for v_i, hv_i in zip(v, hessian_vector_products)]
+
+        x = [torch.zeros_like(g) for g in target_loss_grads]
+        r = list(target_loss_grads)
+        p = list(target_loss_grads)
+        r_dot_r = task_dot(r, r)
+        for _ in range(self.args.implicit_gradient_cg_steps):
+            a_p = matrix_vector_product(p)
+            p_dot_a_p = task_dot(p, a_p)
+            alpha = r_dot_r / p_dot_a_p.masked_fill(p_dot_a_p == 0, 1)
+            x = [x_i + task_scale(alpha, p_i) for x_i, p_i in zip(x, p)]
+            r = [r_i - task_scale(alpha, a_p_i) for r_i, a_p_i in zip(r, a_p)]
+            new_r_dot_r = task_dot(r, r)
+            beta = new_r_dot_r / r_dot_r.masked_fill(r_dot_r == 0, 1)
+            p = [r_i + task_scale(beta, p_i) for r_i, p_i in zip(r, p)]
+            r_dot_r = new_r_dot_r
+
+        return x
+
+    def use_inner_loop_gradient_checkpointing(self, use_second_order):
+        """
+        Returns whether the inner loop steps are checkpointed. Only second order inner loops keep the activations of
+        every step alive until the outer loop backward pass, so first order ones are never checkpointed.
+        :param use_second_order: A boolean flag of whether to use second order derivatives.
+        """
+        return self.args.inner_loop_gradient_checkpointing and use_second_order and torch.is_grad_enabled()
+
+    def get_checkpoint_contexts(self):
+        """
+        Returns the contexts that a checkpointed inner loop step runs in when it is first computed and when it is
+        recomputed during the backward pass. The recomputation must not update the batch norm running statistics again.
+        """
+        return contextlib.nullcontext(), PreservedBatchNormStatistics(self.classifier)
+
+    def get_per_task_means(self, tensors, num_tasks):
+        """
+        Computes the mean of every tensor for each task.
+        :param tensors: An iterable of tensors of shape (num_tasks, ...)
+        :param num_tasks: The number of tasks.
+        :return: A tensor of shape (num_tasks, len(tensors))
+        """
+        # the mean is taken over every dimension but the first, so that it works for any (e.g. channels last) strides
+        return torch.stack([tensor.mean(dim=tuple(range(1, tensor.dim()))) for tensor in tensors], dim=1)
+
+    def standardize_task_state(self, task_state):
+        """
+        Standardizes the task state of every task over all of its elements, i.e. computes (x - mean) / (std + 1e-12)
+        with the unbiased std, as a single fused layer norm.
+        :param task_state: The task states, of shape (num_tasks, ...)
+        :return: The standardized task states.
+        """
+        num_elements = task_state[0].numel()
+        return F.layer_norm(task_state, task_state.shape[1:], eps=1e-24) * \
+               math.sqrt((num_elements - 1) / num_elements)
+
+    def get_tasks_per_pass(self, num_tasks):
+        """
+        Returns how many tasks of a meta-batch are adapted at once in the inner loop.
+        :param num_tasks: The number of tasks in the meta-batch.
+        """
+        return num_tasks if self.args.task_batched_inner_loop else 1
 
     def get_across_task_loss_metrics(self, total_losses, total_accuracies):
         losses = dict()
 
         losses['loss'] = torch.stack(total_losses)
-        losses['accuracy'] = total_accuracies
+        losses['accuracy'] = torch.cat(total_accuracies)
 
         return losses
 
+    def get_host_losses(self, losses):
+        """
+        Averages the metrics of an iteration, which are kept on the device until then, and copies them to the host all
+        at once. This is the only point at which an iteration waits for the device to finish.
+        :param losses: A dictionary with the loss and accuracy of every task and the per step loss importance vector.
+        :return: A dictionary with the mean of every metric, as python floats.
+        """
+        names = list(losses.keys())
+        values = torch.stack([losses[name].float().mean() for name in names]).tolist()
+        return dict(zip(names, values))
+
     def forward(self, data_batch, epoch, use_second_order, use_multi_step_loss_optimization, num_steps, training_phase):
         """
         Runs a forward outer loop pass on the batch of tasks using the MAML/++ framework.
@@ -222,7 +542,8 @@ class MAMLFewShotClassifier(nn.Module):
         target loss (True) or whether to use multi step loss which improves the stability of the system (False)
         :param num_steps: Number of inner loop steps.
         :param training_phase: Whether this is a training phase (True) or an evaluation phase (False)
-        :return: A dictionary with the collected losses of the current outer forward propagation.
+        :return: A dictionary with the collected losses of the current outer forward propagation and the target set
+        predictions of every task, all of which are left on the device.
         """
 
         x_support_set, x_target_set, y_support_set, y_target_set = data_batch
@@ -230,127 +551,113 @@ class MAMLFewShotClassifier(nn.Module):
         [b, ncs, spc] = y_support_set.shape
 
         self.num_classes_per_set = ncs
+        self.use_compiled_networks = len(self.compiled_networks) > 0 and not use_second_order and not (
+                self.args.implicit_meta_gradient and training_phase)
 
         total_losses = []
         total_accuracies = []
-        total_support_accuracies = [[] for i in range(num_steps)]
-        total_target_accuracies = [[] for i in range(num_steps)]
-        per_task_target_preds = [[] for i in range(len(x_target_set))]
-
-        for task_id, (x_support_set_task, y_support_set_task, x_target_set_task, y_target_set_task) in \
-                enumerate(zip(x_support_set,
-                              y_support_set,
-                              x_target_set,
-                              y_target_set)):
+        per_task_target_preds = []
+        tasks_per_pass = self.get_tasks_per_pass(b)
+
+        for first_task_id in range(0, b, tasks_per_pass):
+            task_ids = slice(first_task_id, first_task_id + tasks_per_pass)
+            num_tasks = len(x_support_set[task_ids])
             task_losses = []
-            task_accuracies = []
-            per_step_support_accuracy = []
-            per_step_target_accuracy = []
             per_step_loss_importance_vectors = self.get_per_step_loss_importance_vector()
             names_weights_copy = self.get_inner_loop_parameter_dict(self.classifier.named_parameters())
 
-            num_devices = torch.cuda.device_count() if torch.cuda.is_available() else 1
-
+            # the tasks start from a broadcast view of the meta-parameters, stacked along the first (task) dimension
             names_weights_copy = {
-                name.replace('module.', ''): value.unsqueeze(0).repeat(
-                    [num_devices] + [1 for i in range(len(value.shape))]) for
+                name.replace('module.', ''): value.unsqueeze(0).expand(num_tasks, *value.shape) for
                 name, value in names_weights_copy.items()}
 
-            names_loss_weights_copy_list = []
-            names_query_loss_weights_copy_list = []
             names_loss_weights_copy = self.get_inner_loop_parameter_dict(self.meta_loss.named_parameters())
             names_query_loss_weights_copy = self.get_inner_loop_parameter_dict(self.meta_query_loss.named_parameters())
 
-            names_loss_weights_copy = {
-                name.replace('module.', ''): value.unsqueeze(0).repeat(
-                    [num_devices] + [1 for i in range(len(value.shape))]) for
-                name, value in names_loss_weights_copy.items()}
+            _, n, s, c, h, w = x_target_set[task_ids].shape
+
+            x_support_set_task = x_support_set[task_ids].reshape(num_tasks, -1, c, h, w)
+            y_support_set_task = y_support_set[task_ids].view(num_tasks, -1)
+            y_support_set_one_hot = F.one_hot(y_support_set_task, self.args.num_classes_per_set).to(x_support_set.dtype)
+            x_target_set_task = x_target_set[task_ids].reshape(num_tasks, -1, c, h, w)
+            y_target_set_task = y_target_set[task_ids].view(num_tasks, -1)
+
+            # without per step batch norm, the forward pass of the updated weights on step t (used for the target loss)
+            # is the same as the forward pass that step t + 1 starts from, so it is reused instead of recomputed
+            reuse_logits = not self.args.per_step_bn_statistics
+            logits = None
+
+            # the implicit meta-gradient only needs the adapted weights, so the inner loop is not differentiated through
+            # and its memory does not grow with the number of steps
+            meta_weights = names_weights_copy
+            proximal_weights = None
+            if self.args.implicit_meta_gradient:
+                proximal_weights = {name: value.detach() for name, value in meta_weights.items()}
+                names_weights_copy = {name: value.detach().requires_grad_() for name, value in meta_weights.items()}
+                use_second_order = False
+                use_multi_step_loss_optimization = False
 
-            names_query_loss_weights_copy = {
-                name.replace('module.', ''): value.unsqueeze(0).repeat(
-                    [num_devices] + [1 for i in range(len(value.shape))]) for
-                name, value in names_query_loss_weights_copy.items()}
+            for num_step in range(num_steps):
 
-            n, s, c, h, w = x_target_set_task.shape
+                inner_loop_step_args = (names_weights_copy, logits, x_support_set_task, y_support_set_task,
+                                        y_support_set_one_hot, x_target_set_task, names_loss_weights_copy,
+                                        names_query_loss_weights_copy, use_second_order, num_step, proximal_weights)
 
-            x_support_set_task = x_support_set_task.view(-1, c, h, w)
-            y_support_set_task = y_support_set_task.view(-1)
-            x_target_set_task = x_target_set_task.view(-1, c, h, w)
-            y_target_set_task = y_target_set_task.view(-1)
+                if self.use_inner_loop_gradient_checkpointing(use_second_order):
+                    names_weights_copy = checkpoint(self.inner_loop_step, *inner_loop_step_args, use_reentrant=False,
+                                                    context_fn=self.get_checkpoint_contexts)
+                else:
+                    names_weights_copy = self.inner_loop_step(*inner_loop_step_args)
 
-            for num_step in range(num_steps):
+                if self.args.implicit_meta_gradient:
+                    names_weights_copy = {name: value.detach().requires_grad_() for name, value in
+                                          names_weights_copy.items()}
 
-                meta_loss, support_preds, support_loss = self.net_forward(x=x_support_set_task,
-                                                               y=y_support_set_task,
-                                                               weights=names_weights_copy,
-                                                               backup_running_statistics=
-                                                               True if (num_step == 0) else False,
-                                                               training=True, num_step=num_step,
-                                                               x_t=x_target_set_task,
-                                                               meta_loss_weights=names_loss_weights_copy,
-                                                               meta_query_loss_weights=names_query_loss_weights_copy)
-                generated_alpha_params = {}
-                generated_beta_params = {}
-
-                loss_grads = None
-
-                if self.args.alfa:
-
-                    loss_grads = torch.autograd.grad(meta_loss, names_weights_copy.values(), create_graph=use_second_order)
-                    per_step_task_embedding = []
-                    for k, v in names_weights_copy.items():
-                        per_step_task_embedding.append(v.mean())
-                
-                    for i in range(len(loss_grads)):
-                        per_step_task_embedding.append(loss_grads[i].mean())
-
-                    per_step_task_embedding = torch.stack(per_step_task_embedding)
-
-                    generated_params = self.update_rule_learner(per_step_task_embedding)
-                    num_layers = len(names_weights_copy)
-
-                    generated_alpha, generated_beta = torch.split(generated_params, split_size_or_sections=num_layers)
-                    g = 0
-                    for key in names_weights_copy.keys():
-                        generated_alpha_params[key] = generated_alpha[g]
-                        generated_beta_params[key] = generated_beta[g]
-                        g+=1
-
-                names_weights_copy = self.apply_inner_loop_update(loss=meta_loss,
-                                                                  names_weights_copy=names_weights_copy,
-                                                                  generated_beta_params=generated_beta_params,
-                                                                  generated_alpha_params=generated_alpha_params,
-                                                                  use_second_order=use_second_order,
-                                                                  current_step_idx=num_step,
-                                                                  grads=loss_grads)
+                logits = None
 
                 if use_multi_step_loss_optimization and training_phase and epoch < self.args.multi_step_loss_num_epochs:
+                    logits = self.classifier_forward(x=x_support_set_task, x_t=x_target_set_task,
+                                                     weights=names_weights_copy, backup_running_statistics=False,
+                                                     training=True, num_step=num_step)
                     target_loss, target_preds, _ = self.net_forward(x=x_support_set_task,
                                                                  y=y_support_set_task, weights=names_weights_copy,
                                                                  backup_running_statistics=False, training=True,
                                                                  num_step=num_step,
                                                                  x_t=x_target_set_task,
-                                                                 y_t=y_target_set_task)
+                                                                 y_t=y_target_set_task, logits=logits)
                     
                     task_losses.append(per_step_loss_importance_vectors[num_step] * target_loss)
 
+                    if not reuse_logits:
+                        logits = None
+
                 else:
                     if num_step == (self.args.number_of_training_steps_per_iter - 1):
-                        target_loss, target_preds, _ = self.net_forward(x=x_support_set_task,
-                                                                     y=y_support_set_task, weights=names_weights_copy,
-                                                                     backup_running_statistics=False, training=True,
-                                                                     num_step=num_step,
-                                                                     x_t=x_target_set_task,
-                                                                     y_t=y_target_set_task)
+                        if self.args.implicit_meta_gradient and training_phase:
+                            target_loss, target_preds = self.get_implicit_target_loss(
+                                names_weights_copy=names_weights_copy, meta_weights=meta_weights,
+                                x_support_set_task=x_support_set_task, y_support_set_task=y_support_set_task,
+                                y_support_set_one_hot=y_support_set_one_hot,
+                                x_target_set_task=x_target_set_task, y_target_set_task=y_target_set_task,
+                                names_loss_weights_copy=names_loss_weights_copy,
+                                names_query_loss_weights_copy=names_query_loss_weights_copy, num_step=num_step)
+                        else:
+                            target_loss, target_preds, _ = self.net_forward(x=x_support_set_task,
+                                                                         y=y_support_set_task,
+                                                                         weights=names_weights_copy,
+                                                                         backup_running_statistics=False,
+                                                                         training=True, num_step=num_step,
+                                                                         x_t=x_target_set_task,
+                                                                         y_t=y_target_set_task)
                         task_losses.append(target_loss)
 
-            per_task_target_preds[task_id] = target_preds.detach().cpu().numpy()
-            _, predicted = torch.max(target_preds.data, 1)
+            per_task_target_preds.append(target_preds.detach())
+            _, predicted = torch.max(target_preds.data, 2)
 
-            accuracy = predicted.float().eq(y_target_set_task.data.float()).cpu().float()
-            task_losses = torch.sum(torch.stack(task_losses))
-            total_losses.append(task_losses)
-            total_accuracies.extend(accuracy)
+            accuracy = predicted.float().eq(y_target_set_task.data.float()).float()
+            task_losses = torch.sum(torch.stack(task_losses), dim=0)
+            total_losses.extend(task_losses)
+            total_accuracies.append(accuracy.view(-1))
 
             if not training_phase:
                 if torch.cuda.device_count() > 1:
@@ -362,77 +669,117 @@ class MAMLFewShotClassifier(nn.Module):
                                                    total_accuracies=total_accuracies)
 
         for idx, item in enumerate(per_step_loss_importance_vectors):
-            losses['loss_importance_vector_{}'.format(idx)] = item.detach().cpu().numpy()
+            losses['loss_importance_vector_{}'.format(idx)] = item.detach()
 
-        return losses, per_task_target_preds
+        return losses, torch.cat(per_task_target_preds)
+
+    def get_network(self, name):
+        """
+        Returns one of the networks of the model, compiled if the current forward pass can use the compiled networks.
+        :param name: The name of the network: classifier, meta_loss or meta_query_loss.
+        :return: The (compiled) network.
+        """
+        if self.use_compiled_networks and name in self.compiled_networks:
+            return self.compiled_networks[name]
+
+        return getattr(self, name)
 
-    def net_forward(self, x, y, weights, backup_running_statistics, training, num_step, meta_loss_weights=None, x_t=None, y_t=None, meta_query_loss_weights=None):
+    def classifier_forward(self, x, x_t, weights, backup_running_statistics, training, num_step):
+        """
+        Runs the base model on the support and target images of every task, using the fast weights of each task.
+        :param x: The support images, of shape num_tasks, b, c, h, w
+        :param x_t: The target images, of shape num_tasks, b_t, c, h, w
+        :param weights: A dictionary containing the weights to pass to the network, of shape num_tasks, ...
+        :param backup_running_statistics: A flag indicating whether to reset the batch norm running statistics to their
+         previous values after the run (only for evaluation)
+        :param training: A flag indicating whether the current process phase is a training or evaluation.
+        :param num_step: An integer indicating the number of the step in the inner loop.
+        :return: The logits, of shape num_tasks, b + b_t, num_classes
+        """
+        num_tasks = x.shape[0]
+        images = torch.cat((x, x_t), 1)
+        images = images.transpose(0, 1).reshape(images.shape[1], -1, *images.shape[3:])
+        if self.args.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+
+        with torch.autocast(device_type=torch.device(self.device).type, dtype=self.autocast_dtype,
+                            enabled=self.autocast_dtype != torch.float32):
+            logits = self.get_network('classifier')(x=images, params=tuple(weights.values()),
+                                                    training=training,
+                                                    backup_running_statistics=backup_running_statistics,
+                                                    num_step=num_step)
+
+        # the losses (and the meta-loss networks) are always computed in the precision of the inputs
+        logits = logits.to(dtype=x.dtype)
+        return logits.view(logits.shape[0], num_tasks, -1).transpose(0, 1)
+
+    def net_forward(self, x, y, weights, backup_running_statistics, training, num_step, meta_loss_weights=None, x_t=None, y_t=None, meta_query_loss_weights=None, logits=None, y_one_hot=None):
         """
         A base model forward pass on some data points x. Using the parameters in the weights dictionary. Also requires
         boolean flags indicating whether to reset the running statistics at the end of the run (if at evaluation phase).
         A flag indicating whether this is the training session and an int indicating the current step's number in the
         inner loop.
-        :param x: A data batch of shape b, c, h, w
-        :param y: A data targets batch of shape b, n_classes
-        :param weights: A dictionary containing the weights to pass to the network.
+        :param x: A data batch of shape num_tasks, b, c, h, w
+        :param y: A data targets batch of shape num_tasks, b
+        :param weights: A dictionary containing the weights to pass to the network, of shape num_tasks, ...
         :param backup_running_statistics: A flag indicating whether to reset the batch norm running statistics to their
          previous values after the run (only for evaluation)
         :param training: A flag indicating whether the current process phase is a training or evaluation.
         :param num_step: An integer indicating the number of the step in the inner loop.
-        :return: the crossentropy losses with respect to the given y, the predictions of the base model.
+        :param logits: The output of classifier_forward for these inputs and weights, if it has already been computed.
+        :param y_one_hot: The one-hot version of y, of shape num_tasks, b, num_classes, if it has already been computed.
+        :return: the per task crossentropy losses with respect to the given y, the predictions of the base model.
         """
-        tmp_preds = self.classifier.forward(x=torch.cat((x, x_t), 0), params=weights,
-                                        training=training,
-                                        backup_running_statistics=backup_running_statistics, num_step=num_step)
-        support_preds = tmp_preds[:-x_t.size(0)]
-        query_preds = tmp_preds[-x_t.size(0):]
+        num_tasks, num_support = y.shape
+        tmp_preds = logits
+        if tmp_preds is None:
+            tmp_preds = self.classifier_forward(x=x, x_t=x_t, weights=weights,
+                                                backup_running_statistics=backup_running_statistics,
+                                                training=training, num_step=num_step)
+        support_preds = tmp_preds[:, :num_support]
+        query_preds = tmp_preds[:, num_support:]
 
         if meta_loss_weights is None:
-            loss = F.cross_entropy(input=tmp_preds, target=torch.cat((y, y_t),0))
+            loss = F.cross_entropy(input=tmp_preds.reshape(-1, tmp_preds.shape[-1]),
+                                   target=torch.cat((y, y_t), 1).view(-1), reduction='none')
+            loss = loss.view(num_tasks, -1).mean(dim=1)
             preds = query_preds
             support_loss = loss
 
         else:
-            support_task_state = []
-
-            support_loss = F.cross_entropy(input=support_preds, target=y)
-            support_task_state.append(support_loss)
+            support_loss = F.cross_entropy(input=support_preds.reshape(-1, support_preds.shape[-1]),
+                                           target=y.view(-1), reduction='none')
+            support_loss = support_loss.view(num_tasks, -1).mean(dim=1)
 
-            for v in weights.values():
-                support_task_state.append(v.mean())
+            if y_one_hot is None:
+                y_one_hot = F.one_hot(y, support_preds.shape[-1]).to(support_preds.dtype)
 
-            support_task_state = torch.stack(support_task_state)
-            adapt_support_task_state = (support_task_state - support_task_state.mean())/(support_task_state.std() + 1e-12)                                                 
+            weight_means = self.get_per_task_means(weights.values(), num_tasks)
+            support_task_state = torch.cat((support_loss.view(-1, 1), weight_means), dim=1)
+            adapt_support_task_state = self.standardize_task_state(support_task_state)
 
             updated_meta_loss_weights = self.meta_loss_adapter(adapt_support_task_state, num_step, meta_loss_weights)
 
-            support_y = torch.zeros(support_preds.shape).to(support_preds.device)
-            support_y[torch.arange(support_y.size(0)), y] = 1
-            support_task_state = torch.cat((
-                support_task_state.view(1, -1).expand(support_preds.size(0), -1),
+            support_task_state = self.standardize_task_state(torch.cat((
+                support_task_state.unsqueeze(1).expand(-1, num_support, -1),
                 support_preds,
-                support_y
-            ), -1)                          
-                                                     
-            support_task_state = (support_task_state - support_task_state.mean()) / (support_task_state.std() + 1e-12)
-            meta_support_loss = self.meta_loss(support_task_state, num_step, params=updated_meta_loss_weights).mean().squeeze()
-
-            query_task_state = []
-            for v in weights.values():
-                query_task_state.append(v.mean())
-            out_prob = F.log_softmax(query_preds)
+                y_one_hot
+            ), -1))
+            meta_support_loss = self.get_network('meta_loss')(support_task_state, num_step,
+                                                              params=updated_meta_loss_weights).mean(dim=(1, 2))
+
+            out_prob = F.log_softmax(query_preds, dim=-1)
             instance_entropy = torch.sum(torch.exp(out_prob) * out_prob, dim=-1)
-            query_task_state = torch.stack(query_task_state)
-            query_task_state = torch.cat((
-                        query_task_state.view(1, -1).expand(instance_entropy.size(0), -1), 
+            query_task_state = self.standardize_task_state(torch.cat((
+                        weight_means.unsqueeze(1).expand(-1, instance_entropy.shape[1], -1),
                         query_preds,
-                        instance_entropy.view(-1, 1)
-            ), -1)
-
-            query_task_state = (query_task_state - query_task_state.mean())/(query_task_state.std() + 1e-12)
-            updated_meta_query_loss_weights = self.meta_query_loss_adapter(query_task_state.mean(0), num_step, meta_query_loss_weights)
+                        instance_entropy.unsqueeze(-1)
+            ), -1))
+            updated_meta_query_loss_weights = self.meta_query_loss_adapter(query_task_state.mean(1), num_step,
+                                                                           meta_query_loss_weights)
 
-            meta_query_loss = self.meta_query_loss(query_task_state, num_step, params=updated_meta_query_loss_weights).mean().squeeze()
+            meta_query_loss = self.get_network('meta_query_loss')(query_task_state, num_step,
+                                                                  params=updated_meta_query_loss_weights).mean(dim=(1, 2))
 
             loss = support_loss + meta_query_loss + meta_support_loss
 
@@ -482,10 +829,11 @@ class MAMLFewShotClassifier(nn.Module):
         Applies an outer loop update on the meta-parameters of the model.
         :param loss: The current crossentropy loss.
         """
-        loss.backward()
+        self.grad_scaler.scale(loss).backward()
 
         if task_idx == self.args.batch_size - 1:
-            self.optimizer.step()
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
 
     def run_train_iter(self, data_batch, epoch):
         """
@@ -504,35 +852,41 @@ class MAMLFewShotClassifier(nn.Module):
 
         x_support_set, x_target_set, y_support_set, y_target_set = data_batch
 
-        x_support_set = torch.Tensor(x_support_set).float().to(device=self.device)
-        x_target_set = torch.Tensor(x_target_set).float().to(device=self.device)
-        y_support_set = torch.Tensor(y_support_set).long().to(device=self.device)
-        y_target_set = torch.Tensor(y_target_set).long().to(device=self.device)
+        x_support_set = torch.as_tensor(x_support_set).float().to(device=self.device)
+        x_target_set = torch.as_tensor(x_target_set).float().to(device=self.device)
+        y_support_set = torch.as_tensor(y_support_set).long().to(device=self.device)
+        y_target_set = torch.as_tensor(y_target_set).long().to(device=self.device)
 
         stacked_loss = None
         stacked_acc = None
         self.optimizer.zero_grad()
 
-        for nt in range(self.args.batch_size):
-            x_support_set_t = x_support_set[nt:nt+1]
-            y_support_set_t = y_support_set[nt:nt+1]
-            x_target_set_t = x_target_set[nt:nt+1]
-            y_target_set_t = y_target_set[nt:nt+1]
+        tasks_per_pass = self.get_tasks_per_pass(self.args.batch_size)
+        with HostSyncCounter(self.device, enabled=self.args.count_host_syncs) as host_sync_counter:
+            for nt in range(0, self.args.batch_size, tasks_per_pass):
+                x_support_set_t = x_support_set[nt:nt+tasks_per_pass]
+                y_support_set_t = y_support_set[nt:nt+tasks_per_pass]
+                x_target_set_t = x_target_set[nt:nt+tasks_per_pass]
+                y_target_set_t = y_target_set[nt:nt+tasks_per_pass]
 
-            data_batch = (x_support_set_t, x_target_set_t, y_support_set_t, y_target_set_t)
+                data_batch = (x_support_set_t, x_target_set_t, y_support_set_t, y_target_set_t)
 
-            losses, per_task_target_preds = self.train_forward_prop(data_batch=data_batch, epoch=epoch)
-            self.meta_update(loss=losses['loss']/self.args.batch_size, task_idx=nt)
+                losses, per_task_target_preds = self.train_forward_prop(data_batch=data_batch, epoch=epoch)
+                self.meta_update(loss=losses['loss'].sum()/self.args.batch_size, task_idx=nt+len(x_support_set_t)-1)
 
-            if stacked_loss is None:
-                stacked_loss = losses['loss'].detach()
-                stacked_acc = losses['accuracy']
-            else:
-                stacked_loss = torch.cat((stacked_loss, losses['loss'].detach()), 0)
-                stacked_acc = np.concatenate((stacked_acc, losses['accuracy']), 0)
+                if stacked_loss is None:
+                    stacked_loss = losses['loss'].detach()
+                    stacked_acc = losses['accuracy']
+                else:
+                    stacked_loss = torch.cat((stacked_loss, losses['loss'].detach()), 0)
+                    stacked_acc = torch.cat((stacked_acc, losses['accuracy']), 0)
 
-        losses['loss'] = torch.mean(stacked_loss).item()
-        losses['accuracy'] = np.mean(stacked_acc)
+        losses['loss'] = stacked_loss
+        losses['accuracy'] = stacked_acc
+        losses = self.get_host_losses(losses)
+        per_task_target_preds = per_task_target_preds.cpu().numpy()
+        if self.args.count_host_syncs:
+            losses['host_syncs'] = host_sync_counter.count
 
         losses['learning_rate'] = self.scheduler.get_lr()[0]
 
@@ -554,15 +908,19 @@ class MAMLFewShotClassifier(nn.Module):
 
         x_support_set, x_target_set, y_support_set, y_target_set = data_batch
 
-        x_support_set = torch.Tensor(x_support_set).float().to(device=self.device)
-        x_target_set = torch.Tensor(x_target_set).float().to(device=self.device)
-        y_support_set = torch.Tensor(y_support_set).long().to(device=self.device)
-        y_target_set = torch.Tensor(y_target_set).long().to(device=self.device)
+        x_support_set = torch.as_tensor(x_support_set).float().to(device=self.device)
+        x_target_set = torch.as_tensor(x_target_set).float().to(device=self.device)
+        y_support_set = torch.as_tensor(y_support_set).long().to(device=self.device)
+        y_target_set = torch.as_tensor(y_target_set).long().to(device=self.device)
         data_batch = (x_support_set, x_target_set, y_support_set, y_target_set)
 
-        losses, per_task_target_preds = self.evaluation_forward_prop(data_batch=data_batch, epoch=self.current_epoch)
-        losses['loss'] = torch.mean(losses['loss']).item()
-        losses['accuracy'] = np.mean(losses['accuracy'])
+        with HostSyncCounter(self.device, enabled=self.args.count_host_syncs) as host_sync_counter:
+            losses, per_task_target_preds = self.evaluation_forward_prop(data_batch=data_batch,
+                                                                         epoch=self.current_epoch)
+        losses = self.get_host_losses(losses)
+        per_task_target_preds = per_task_target_preds.cpu().numpy()
+        if self.args.count_host_syncs:
+            losses['host_syncs'] = host_sync_counter.count
 
         return losses, per_task_target_preds
 
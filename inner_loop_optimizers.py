@@ -98,41 +98,46 @@ class LSLRGradientDescentLearningRule(nn.Module):
         self.init_bias_decay = torch.ones(1) 
 
     def initialise(self, names_weights_dict):
+        self.names = list(names_weights_dict.keys())
+        self.shapes = [param.shape for param in names_weights_dict.values()]
+        num_layers = len(self.names)
+
         if self.alfa:
+            # the per-step per-layer meta-learnable bias terms are stacked into (total_num_inner_loop_steps + 1, num_layers)
             if self.random_init:
-                self.names_beta_dict_per_param = nn.ParameterDict()
-
-            self.names_alpha_dict = nn.ParameterDict()
-            self.names_beta_dict = nn.ParameterDict()
-
-            for idx, (key, param) in enumerate(names_weights_dict.items()):
-
-                if self.random_init:
                 # per-param weight decay for random init
-                    self.names_beta_dict_per_param[key.replace(".", "-")] = nn.Parameter(
-                        data=torch.ones(param.shape) * self.init_weight_decay * self.init_learning_rate,
-                        requires_grad=self.use_learnable_learning_rates)
-
-                    self.names_beta_dict[key.replace(".", "-")] = nn.Parameter(
-                        data=torch.ones(self.total_num_inner_loop_steps + 1),
-                        requires_grad=self.use_learnable_learning_rates)
-                else:
-                    # per-step per-layer meta-learnable weight decay bias term (for more stable training and better performance by 2~3%)
-                    self.names_beta_dict[key.replace(".", "-")] = nn.Parameter(
-                        data=torch.ones(self.total_num_inner_loop_steps + 1) * self.init_weight_decay * self.init_learning_rate,
-                        requires_grad=self.use_learnable_learning_rates)
-
-                # per-step per-layer meta-learnable learning rate bias term (for more stable training and better performance by 2~3%)
-                self.names_alpha_dict[key.replace(".", "-")] = nn.Parameter(
-                    data=torch.ones(self.total_num_inner_loop_steps + 1) * self.init_learning_rate,
+                self.beta_per_param = nn.Parameter(
+                    data=torch.ones(sum(shape.numel() for shape in self.shapes)) * self.init_weight_decay *
+                    self.init_learning_rate,
                     requires_grad=self.use_learnable_learning_rates)
-        else:
-            self.names_learning_rates_dict = nn.ParameterDict()
-            for idx, (key, param) in enumerate(names_weights_dict.items()):
-                self.names_learning_rates_dict[key.replace(".", "-")] = nn.Parameter(
-                    data=torch.ones(self.total_num_inner_loop_steps + 1) * self.init_learning_rate,
+
+                self.beta = nn.Parameter(
+                    data=torch.ones(self.total_num_inner_loop_steps + 1, num_layers),
+                    requires_grad=self.use_learnable_learning_rates)
+            else:
+                # per-step per-layer meta-learnable weight decay bias term (for more stable training and better performance by 2~3%)
+                self.beta = nn.Parameter(
+                    data=torch.ones(self.total_num_inner_loop_steps + 1, num_layers) * self.init_weight_decay * self.init_learning_rate,
                     requires_grad=self.use_learnable_learning_rates)
 
+            # per-step per-layer meta-learnable learning rate bias term (for more stable training and better performance by 2~3%)
+            self.alpha = nn.Parameter(
+                data=torch.ones(self.total_num_inner_loop_steps + 1, num_layers) * self.init_learning_rate,
+                requires_grad=self.use_learnable_learning_rates)
+        else:
+            # per-step per-layer learning rates, stacked into (total_num_inner_loop_steps + 1, num_layers)
+            self.learning_rates = nn.Parameter(
+                data=torch.ones(self.total_num_inner_loop_steps + 1, num_layers) * self.init_learning_rate,
+                requires_grad=self.use_learnable_learning_rates)
+
+    def unflatten(self, flat_tensor):
+        """
+        Splits flattened inner loop parameters back into a view for every parameter.
+        :param flat_tensor: A tensor of shape (num_elements,)
+        :return: A dictionary with a tensor of the shape of every inner loop parameter.
+        """
+        tensors = torch.split(flat_tensor, [shape.numel() for shape in self.shapes])
+        return {name: tensor.view(shape) for name, tensor, shape in zip(self.names, tensors, self.shapes)}
 
     def update_params(self, names_weights_dict, names_grads_wrt_params_dict, generated_alpha_params, generated_beta_params, num_step, tau=0.1):
         """Applies a single gradient descent update to all parameters.
@@ -142,25 +147,50 @@ class LSLRGradientDescentLearningRule(nn.Module):
             grads_wrt_params: A list of gradients of the scalar loss function
                 with respect to each of the parameters passed to `initialise`
                 previously, with this list expected to be in the same order.
+            generated_alpha_params, generated_beta_params: The learning rate and weight decay multipliers generated
+                by ALFA for every task and layer, of shape (num_tasks, num_layers).
         """
         updated_names_weights_dict = dict()
 
-        for key in names_grads_wrt_params_dict.keys():
+        if self.alfa:
             # beta = (1 - generated_beta * meta-learned per-step-per-layer bias term)
             # alpha = generated_alpha * meta-learned per-step-per-layer bias term)
-            if self.alfa:
+            # the (num_tasks, num_layers) terms are broadcast over every layer's weights, which is cheaper than
+            # gathering them to every element of a flattened buffer
+            alpha = generated_alpha_params * self.alpha[num_step]
+            beta = generated_beta_params * self.beta[num_step]
+            beta_per_param = self.unflatten(self.beta_per_param) if self.random_init else None
+
+            for idx, (key, weights) in enumerate(names_weights_dict.items()):
+                layer_alpha = alpha[:, idx].view(-1, *[1] * (weights.dim() - 1))
+                layer_beta = beta[:, idx].view(-1, *[1] * (weights.dim() - 1))
                 if self.random_init:
-                    updated_names_weights_dict[key] = (1 - self.names_beta_dict_per_param[key.replace(".", "-")] * generated_beta_params[key] * self.names_beta_dict[key.replace(".", "-")][num_step]) * names_weights_dict[key] - generated_alpha_params[key] * self.names_alpha_dict[key.replace(".", "-")][num_step] * names_grads_wrt_params_dict[key]
-                else:
-                    updated_names_weights_dict[key] = (1 - generated_beta_params[key] * self.names_beta_dict[key.replace(".", "-")][num_step]) * names_weights_dict[key] - generated_alpha_params[key] * self.names_alpha_dict[key.replace(".", "-")][num_step] * names_grads_wrt_params_dict[key]
-            else:
-                #updated_names_weights_dict[key] = names_weights_dict[key] - self.init_lr_val * names_grads_wrt_params_dict[key]
-                for key in names_grads_wrt_params_dict.keys():
-                    updated_names_weights_dict[key] = names_weights_dict[key] - \
-                                                      self.names_learning_rates_dict[key.replace(".", "-")][num_step] * names_grads_wrt_params_dict[key]
+                    layer_beta = layer_beta * beta_per_param[key]
+                updated_names_weights_dict[key] = torch.addcmul(weights, layer_beta, weights, value=-1).addcmul_(
+                    layer_alpha, names_grads_wrt_params_dict[key], value=-1)
 
+            return updated_names_weights_dict
 
+        learning_rates = self.learning_rates[num_step]
+        for idx, (key, weights) in enumerate(names_weights_dict.items()):
+            updated_names_weights_dict[key] = torch.addcmul(weights, learning_rates[idx],
+                                                            names_grads_wrt_params_dict[key], value=-1)
 
         return updated_names_weights_dict
 
-
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # models saved before the learning rates and ALFA bias terms were stacked store them per parameter
+        per_layer_keys = [prefix + 'names_learning_rates_dict.' + name.replace(".", "-") for name in self.names]
+        if not self.alfa and all(key in state_dict for key in per_layer_keys):
+            state_dict[prefix + 'learning_rates'] = torch.stack([state_dict.pop(key) for key in per_layer_keys], dim=1)
+
+        per_layer_keys = [prefix + 'names_alpha_dict.' + name.replace(".", "-") for name in self.names]
+        if self.alfa and all(key in state_dict for key in per_layer_keys):
+            for name, dict_name in (('alpha', 'names_alpha_dict'), ('beta', 'names_beta_dict')):
+                state_dict[prefix + name] = torch.stack(
+                    [state_dict.pop(prefix + dict_name + '.' + key.replace(".", "-")) for key in self.names], dim=1)
+            if self.random_init:
+                state_dict[prefix + 'beta_per_param'] = torch.cat(
+                    [state_dict.pop(prefix + 'names_beta_dict_per_param.' + key.replace(".", "-")).view(-1)
+                     for key in self.names])
+        super(LSLRGradientDescentLearningRule, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
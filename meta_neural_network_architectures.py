@@ -1,3 +1,4 @@
+import math
 import numbers
 from copy import copy
 
@@ -5,6 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch
 import numpy as np
+from torch.nn.parallel._functions import Broadcast
 
 
 
@@ -38,6 +40,106 @@ def extract_top_level_dict(current_dict):
     #print(current_dict.keys(), output_dict.keys())
     return output_dict
 
+
+def meta_linear(x, weight, bias):
+    """
+    Applies a linear function (Wx + b), either shared by all tasks or with a separate weight and bias per task.
+    :param x: Input data batch, in the form (b, f), or (num_tasks, b, f)
+    :param weight: The weight, of shape (out_f, f), or (num_tasks, out_f, f) to apply it per task.
+    :param bias: The bias, of shape (out_f), or (num_tasks, out_f) to apply it per task. Can be None.
+    :return: The result of the linear function.
+    """
+    if weight.dim() == 3:
+        if bias is None:
+            return torch.bmm(x, weight.transpose(1, 2))
+        return torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+
+    return F.linear(input=x, weight=weight, bias=bias)
+
+
+def conv_output_shape(input_shape, num_filters, kernel_size, stride, padding):
+    """
+    Computes the output shape of a convolution without running it.
+    :param input_shape: The input shape in the form (b, c, h, w)
+    :param num_filters: The number of filters of the convolution
+    :param kernel_size: The kernel size of the convolution
+    :param stride: The stride of the convolution
+    :param padding: The padding of the convolution
+    :return: The output shape in the form (b, num_filters, h, w)
+    """
+    b, c, h, w = input_shape
+    return torch.Size([b, num_filters, (h + 2 * padding - kernel_size) // stride + 1,
+                       (w + 2 * padding - kernel_size) // stride + 1])
+
+
+def pool_output_shape(input_shape, kernel_size, stride, padding=0):
+    """
+    Computes the output shape of a max or average pooling without running it.
+    :param input_shape: The input shape in the form (b, c, h, w)
+    :param kernel_size: The kernel size of the pooling
+    :param stride: The stride of the pooling
+    :param padding: The padding of the pooling
+    :return: The output shape in the form (b, c, h, w)
+    """
+    b, c, h, w = input_shape
+    return torch.Size([b, c, (h + 2 * padding - kernel_size) // stride + 1, (w + 2 * padding - kernel_size) // stride + 1])
+
+
+def stack_per_step_state_dict(state_dict, prefix, num_steps, per_step_names):
+    """
+    Converts the state dict entries of a module that used to hold a separate sub-module per inner loop step to the
+    entries of its parameters stacked along the step dimension, so that models saved before still load.
+    :param state_dict: The state dict that is being loaded, updated in place.
+    :param prefix: The prefix of the module's entries in the state dict.
+    :param num_steps: The number of inner loop steps.
+    :param per_step_names: A dictionary mapping each stacked parameter name to the format of its per step names.
+    """
+    for name, per_step_name in per_step_names.items():
+        per_step_keys = [prefix + per_step_name.format(i) for i in range(num_steps)]
+        if all(key in state_dict for key in per_step_keys):
+            state_dict[prefix + name] = torch.stack([state_dict.pop(key) for key in per_step_keys])
+
+
+def assign_fast_weight_slots(network, names):
+    """
+    Stores in every layer of a network the position of each of its parameters in a tuple of fast weights. Layers that
+    receive such a tuple as their params pick their weights by index, without any per call dictionary processing.
+    :param network: The network whose layers should receive the slots.
+    :param names: The parameter names (as in network.named_parameters()), in the order of the fast weights tuple.
+    Parameters that are not in names keep using the layer's own parameters.
+    """
+    slots = {name: idx for idx, name in enumerate(names)}
+    for module_name, module in network.named_modules():
+        for param_name, _ in module.named_parameters(recurse=False):
+            full_name = param_name if module_name == "" else "{}.{}".format(module_name, param_name)
+            setattr(module, "{}_slot".format(param_name), slots.get(full_name))
+
+class MetaDataParallel(nn.DataParallel):
+    """
+    A DataParallel wrapper for the meta networks. The inputs are split across the devices as usual, while the tuple of
+    fast weights passed as params is broadcast, so that every device works with the full set of weights. The weights
+    are only copied here, when there is more than one device to run on.
+    """
+
+    def scatter(self, inputs, kwargs, device_ids):
+        params = kwargs.pop('params', None)
+        inputs, kwargs = super(MetaDataParallel, self).scatter(inputs, kwargs, device_ids)
+
+        if isinstance(params, tuple):
+            num_replicas = len(kwargs)
+            if num_replicas == 1:
+                kwargs[0]['params'] = params
+            else:
+                replicas = Broadcast.apply(device_ids[:num_replicas], *params)
+                for idx in range(num_replicas):
+                    kwargs[idx]['params'] = tuple(replicas[idx * len(params):(idx + 1) * len(params)])
+        else:
+            for replica_kwargs in kwargs:
+                replica_kwargs['params'] = params
+
+        return inputs, kwargs
+
+
 class MetaMaxResLayerReLU(nn.Module):
     def __init__(self, input_shape, num_filters, kernel_size, stride, padding, use_bias, args, normalization=True,
                  meta_layer=True, no_bn_learnable_params=False, device=None, downsample=None, max_padding=0, maxpool=True):
@@ -76,12 +178,7 @@ class MetaMaxResLayerReLU(nn.Module):
 
     def build_block(self):
 
-        x = torch.zeros(self.input_shape)
-
-        identity = x
-        out = x
-
-        self.conv1 = MetaConvNormLayerSwish(input_shape=out.shape,
+        self.conv1 = MetaConvNormLayerSwish(input_shape=self.input_shape,
                                                                         num_filters=self.num_filters,
                                                                         kernel_size=3, stride=self.stride,
                                                                         padding=1,
@@ -90,9 +187,8 @@ class MetaMaxResLayerReLU(nn.Module):
                                                                         meta_layer=self.meta_layer,
                                                                         no_bn_learnable_params=False,
                                                                         device=self.device)
-        out = self.conv1(out, training=True, num_step=0)
 
-        self.conv2 = MetaConvNormLayerSwish(input_shape=out.shape,
+        self.conv2 = MetaConvNormLayerSwish(input_shape=self.conv1.output_shape,
                                                                         num_filters=self.num_filters,
                                                                         kernel_size=3, stride=self.stride,
                                                                         padding=1,
@@ -101,48 +197,36 @@ class MetaMaxResLayerReLU(nn.Module):
                                                                         meta_layer=self.meta_layer,
                                                                         no_bn_learnable_params=False,
                                                                         device=self.device)
-        out = self.conv2(out, training=True, num_step=0)
+        out_shape = self.conv2.output_shape
 
-        self.conv3 = MetaConv2dLayer(in_channels=out.shape[1], out_channels=out.shape[1],
+        self.conv3 = MetaConv2dLayer(in_channels=out_shape[1], out_channels=out_shape[1],
                                     kernel_size=3,
                                     stride=1, padding=self.padding, use_bias=self.use_bias)
 
-        out = self.conv3(out)
+        out_shape = conv_output_shape(out_shape, out_shape[1], kernel_size=3, stride=1, padding=self.padding)
 
-        self.norm_layer = MetaBatchNormLayer(out.shape[1], track_running_stats=True,
+        self.norm_layer = MetaBatchNormLayer(out_shape[1], track_running_stats=True,
                                                      meta_batch_norm=self.meta_layer,
                                                      no_learnable_params=self.no_bn_learnable_params,
                                                      device=self.device,
                                                      use_per_step_bn_statistics=self.use_per_step_bn_statistics,
                                                      args=self.args)
 
-        out = self.norm_layer(out, num_step=0)
-
-        self.shortcut_conv = MetaConv2dLayer(in_channels=identity.shape[1], out_channels=out.shape[1],
+        self.shortcut_conv = MetaConv2dLayer(in_channels=self.input_shape[1], out_channels=out_shape[1],
                                 kernel_size=1,
                                 stride=1, padding=0, use_bias=self.use_bias)
 
-        self.shortcut_norm_layer = MetaBatchNormLayer(out.shape[1], track_running_stats=True,
+        self.shortcut_norm_layer = MetaBatchNormLayer(out_shape[1], track_running_stats=True,
                                                      meta_batch_norm=self.meta_layer,
                                                      no_learnable_params=self.no_bn_learnable_params,
                                                      device=self.device,
                                                      use_per_step_bn_statistics=self.use_per_step_bn_statistics,
                                                      args=self.args)
 
-        identity = self.shortcut_conv(identity)
-        identity = self.shortcut_norm_layer(identity, num_step=0)
-
-        out += identity
-
-        #out = F.relu(out)
-        #
-        out = F.relu_(out)
-
         if self.maxpool:
-            out = F.max_pool2d(input=out, kernel_size=(2, 2), stride=2, padding=self.max_padding)
+            out_shape = pool_output_shape(out_shape, kernel_size=2, stride=2, padding=self.max_padding)
 
-
-        print(out.shape)
+        self.output_shape = out_shape
 
     def forward(self, x, num_step, params=None, training=False, backup_running_statistics=False):
         """
@@ -165,7 +249,11 @@ class MetaMaxResLayerReLU(nn.Module):
         norm_params_shortcut = None
         activation_function_pre_params = None
 
-        if params is not None:
+        if isinstance(params, tuple):
+            conv_params_1 = conv_params_2 = conv_params_3 = conv_params_shortcut = params
+            norm_params = norm_params_shortcut = params
+
+        elif params is not None:
             params = extract_top_level_dict(current_dict=params)
 
             if self.normalization:
@@ -206,11 +294,12 @@ class MetaMaxResLayerReLU(nn.Module):
                                           backup_running_statistics=backup_running_statistics)
         out += identity
 
-        out = F.relu_(out)
-
+        # max pooling commutes with the ReLU, so pooling first means the ReLU and its backward pass (which are part of
+        # the graph that second order inner loops differentiate through) only see a quarter of the elements
         if self.maxpool:
             out = F.max_pool2d(input=out, kernel_size=(2, 2), stride=2, padding=self.max_padding)
 
+        out = F.relu_(out)
 
         return out
 
@@ -259,21 +348,15 @@ class MetaConvNormLayerSwish(nn.Module):
 
     def build_block(self):
 
-        x = torch.zeros(self.input_shape)
-
-        out = x
-
-        self.conv = MetaConv2dLayer(in_channels=out.shape[1], out_channels=self.num_filters,
+        self.conv = MetaConv2dLayer(in_channels=self.input_shape[1], out_channels=self.num_filters,
                                     kernel_size=self.kernel_size,
                                     stride=self.stride, padding=self.padding, use_bias=self.use_bias)
 
-
-
-        out = self.conv(out)
+        out_shape = conv_output_shape(self.input_shape, self.num_filters, self.kernel_size, self.stride, self.padding)
 
         if self.normalization:
             if self.args.norm_layer == "batch_norm":
-                self.norm_layer = MetaBatchNormLayer(out.shape[1], track_running_stats=True,
+                self.norm_layer = MetaBatchNormLayer(out_shape[1], track_running_stats=True,
                                                      meta_batch_norm=self.meta_layer,
                                                      no_learnable_params=self.no_bn_learnable_params,
                                                      device=self.device,
@@ -281,13 +364,9 @@ class MetaConvNormLayerSwish(nn.Module):
                                                      args=self.args)
 
             elif self.args.norm_layer == "layer_norm":
-                self.norm_layer = MetaLayerNormLayer(input_feature_shape=out.shape[1:])
-
-            out = self.norm_layer(out, num_step=0)
-
-        out = F.relu_(out)
+                self.norm_layer = MetaLayerNormLayer(input_feature_shape=out_shape[1:])
 
-        print(out.shape)
+        self.output_shape = out_shape
 
     def forward(self, x, num_step, params=None, training=False, backup_running_statistics=False):
         """
@@ -306,7 +385,10 @@ class MetaConvNormLayerSwish(nn.Module):
         conv_params = None
         activation_function_pre_params = None
 
-        if params is not None:
+        if isinstance(params, tuple):
+            conv_params = batch_norm_params = params
+
+        elif params is not None:
             params = extract_top_level_dict(current_dict=params)
 
             if self.normalization:
@@ -367,15 +449,24 @@ class MetaConv2dLayer(nn.Module):
         if self.use_bias:
             self.bias = nn.Parameter(torch.zeros(num_filters))
 
+        self.weight_slot = None
+        self.bias_slot = None
+
     def forward(self, x, params=None):
         """
         Applies a conv2D forward pass. If params are not None will use the passed params as the conv weights and biases
         :param x: Input image batch.
         :param params: If none, then conv layer will use the stored self.weights and self.bias, if they are not none
-        then the conv layer will use the passed params as its parameters.
+        then the conv layer will use the passed params as its parameters. A tuple of fast weights is indexed with the
+        slots set by assign_fast_weight_slots.
         :return: The output of a convolutional function.
         """
-        if params is not None:
+        if isinstance(params, tuple):
+            weight = self.weight if self.weight_slot is None else params[self.weight_slot]
+            bias = None
+            if self.use_bias:
+                bias = self.bias if self.bias_slot is None else params[self.bias_slot]
+        elif params is not None:
             params = extract_top_level_dict(current_dict=params)
             if self.use_bias:
                 (weight, bias) = params["weight"], params["bias"]
@@ -390,8 +481,17 @@ class MetaConv2dLayer(nn.Module):
                 weight = self.weight
                 bias = None
 
+        groups = self.groups
+        if weight.dim() == 5:
+            # per task weights, the channels of the tasks are stacked along the channel dimension of x
+            num_tasks = weight.shape[0]
+            weight = weight.reshape(-1, *weight.shape[2:])
+            if bias is not None:
+                bias = bias.reshape(-1)
+            groups = groups * num_tasks
+
         out = F.conv2d(input=x, weight=weight, bias=bias, stride=self.stride,
-                       padding=self.padding, dilation=self.dilation_rate, groups=self.groups)
+                       padding=self.padding, dilation=self.dilation_rate, groups=groups)
         return out
 
 
@@ -415,16 +515,24 @@ class MetaLinearLayer(nn.Module):
         if self.use_bias:
             self.bias = nn.Parameter(torch.zeros(num_filters))
 
+        self.weights_slot = None
+        self.bias_slot = None
+
     def forward(self, x, params=None):
         """
         Forward propagates by applying a linear function (Wx + b). If params are none then internal params are used.
         Otherwise passed params will be used to execute the function.
-        :param x: Input data batch, in the form (b, f)
+        :param x: Input data batch, in the form (b, f), or (num_tasks, b, f)
         :param params: A dictionary containing 'weights' and 'bias'. If params are none then internal params are used.
-        Otherwise the external are used.
+        Otherwise the external are used. Weights with a leading num_tasks dimension are applied per task.
         :return: The result of the linear function.
         """
-        if params is not None:
+        if isinstance(params, tuple):
+            weight = self.weights if self.weights_slot is None else params[self.weights_slot]
+            bias = None
+            if self.use_bias:
+                bias = self.bias if self.bias_slot is None else params[self.bias_slot]
+        elif params is not None:
             params = extract_top_level_dict(current_dict=params)
             if self.use_bias:
                 (weight, bias) = params["weights"], params["bias"]
@@ -441,8 +549,7 @@ class MetaLinearLayer(nn.Module):
                 weight = self.weights
                 bias = None
         # print(x.shape)
-        out = F.linear(input=x, weight=weight, bias=bias)
-        return out
+        return meta_linear(x, weight, bias)
 
 
 class MetaBatchNormLayer(nn.Module):
@@ -507,6 +614,9 @@ class MetaBatchNormLayer(nn.Module):
 
         self.momentum = momentum
 
+        self.weight_slot = None
+        self.bias_slot = None
+
     def forward(self, input, num_step, params=None, training=False, backup_running_statistics=False):
         """
         Forward propagates by applying a bach norm function. If params are none then internal params are used.
@@ -520,7 +630,12 @@ class MetaBatchNormLayer(nn.Module):
         at evaluation time, when after the pass is complete we want to throw away the collected validation stats.
         :return: The result of the batch norm operation.
         """
-        if params is not None:
+        if isinstance(params, tuple):
+            if self.weight_slot is None and self.bias_slot is None:
+                params = None
+            weight = self.weight if self.weight_slot is None else params[self.weight_slot]
+            bias = self.bias if self.bias_slot is None else params[self.bias_slot]
+        elif params is not None:
             params = extract_top_level_dict(current_dict=params)
             (weight, bias) = params["weight"], params["bias"]
             #print(num_step, params['weight'])
@@ -541,15 +656,61 @@ class MetaBatchNormLayer(nn.Module):
 
 
         if backup_running_statistics and self.use_per_step_bn_statistics:
-            self.backup_running_mean.data = copy(self.running_mean.data)
-            self.backup_running_var.data = copy(self.running_var.data)
+            self.backup_stats()
 
         momentum = self.momentum
 
-        output = F.batch_norm(input, running_mean, running_var, weight, bias,
+        # the backward pass of a batch norm (and its double backward, in second order inner loops) easily overflows in
+        # float16, so under float16 autocast it is computed in float32 and only its output is cast back
+        input_dtype = input.dtype
+        if input_dtype == torch.float16:
+            input = input.float()
+
+        # the channels of several tasks can be stacked along dim 1, each task is normalized with its own statistics
+        num_tasks = input.shape[1] // self.num_features
+        if num_tasks == 1 and weight.dim() == 1:
+            return F.batch_norm(input, running_mean, running_var, weight, bias,
+                                training=True, momentum=momentum, eps=self.eps).to(dtype=input_dtype)
+
+        weight = weight.reshape(-1) if weight.dim() > 1 else weight.repeat(num_tasks)
+        bias = bias.reshape(-1) if bias.dim() > 1 else bias.repeat(num_tasks)
+
+        if running_mean is None:
+            return F.batch_norm(input, None, None, weight, bias, training=True, momentum=momentum,
+                                eps=self.eps).to(dtype=input_dtype)
+
+        task_running_mean = running_mean.repeat(num_tasks)
+        task_running_var = running_var.repeat(num_tasks)
+        output = F.batch_norm(input, task_running_mean, task_running_var, weight, bias,
                               training=True, momentum=momentum, eps=self.eps)
 
-        return output
+        with torch.no_grad():
+            self.accumulate_task_statistics(running_mean, task_running_mean, num_tasks)
+            self.accumulate_task_statistics(running_var, task_running_var, num_tasks)
+
+        return output.to(dtype=input_dtype)
+
+    def accumulate_task_statistics(self, running_stat, task_running_stats, num_tasks):
+        """
+        Folds the running statistics that were updated independently per task back into the shared running
+        statistics, as if the tasks had been run one after the other.
+        :param running_stat: The shared running statistic, updated in place.
+        :param task_running_stats: The per task running statistics, of shape (num_tasks * num_features).
+        :param num_tasks: The number of stacked tasks.
+        """
+        decay = 1 - self.momentum
+        task_updates = task_running_stats.view(num_tasks, -1) - decay * running_stat
+        for task_update in task_updates:
+            running_stat.mul_(decay).add_(task_update)
+
+    @torch.compiler.disable
+    def backup_stats(self):
+        """
+        Stores the running statistics in their backup. It is kept out of compiled graphs (torch.compile), which can't
+        take the backup and the running statistics as inputs, as they share their storage.
+        """
+        self.backup_running_mean.data = copy(self.running_mean.data)
+        self.backup_running_var.data = copy(self.running_var.data)
 
     def restore_backup_stats(self):
         """
@@ -588,6 +749,7 @@ class MetaLayerNormLayer(nn.Module):
             self.register_parameter('weight', None)
             self.register_parameter('bias', None)
         self.reset_parameters()
+        self.bias_slot = None
 
     def reset_parameters(self):
         """
@@ -610,13 +772,21 @@ class MetaLayerNormLayer(nn.Module):
             at evaluation time, when after the pass is complete we want to throw away the collected validation stats.
             :return: The result of the batch norm operation.
         """
-        if params is not None:
+        if isinstance(params, tuple):
+            bias = self.bias if self.bias_slot is None else params[self.bias_slot]
+        elif params is not None:
             params = extract_top_level_dict(current_dict=params)
             bias = params["bias"]
         else:
             bias = self.bias
             #print('no inner loop params', self)
 
+        if input.shape[1] != self.normalized_shape[0] or bias.dim() > len(self.normalized_shape):
+            # the channels of several tasks are stacked along dim 1, normalize each task separately
+            out = F.layer_norm(input.reshape(input.shape[0], -1, *self.normalized_shape), self.normalized_shape,
+                               eps=self.eps)
+            return (out * self.weight + bias).reshape(input.shape)
+
         return F.layer_norm(
             input, self.normalized_shape, self.weight, bias, self.eps)
 
@@ -663,32 +833,24 @@ class MetaConvNormLayerReLU(nn.Module):
 
     def build_block(self):
 
-        x = torch.zeros(self.input_shape)
-
-        out = x
-
-        self.conv = MetaConv2dLayer(in_channels=out.shape[1], out_channels=self.num_filters,
+        self.conv = MetaConv2dLayer(in_channels=self.input_shape[1], out_channels=self.num_filters,
                                     kernel_size=self.kernel_size,
                                     stride=self.stride, padding=self.padding, use_bias=self.use_bias)
 
-        out = self.conv(out)
+        out_shape = conv_output_shape(self.input_shape, self.num_filters, self.kernel_size, self.stride, self.padding)
 
         if self.normalization:
             if self.args.norm_layer == "batch_norm":
-                self.norm_layer = MetaBatchNormLayer(out.shape[1], track_running_stats=True,
+                self.norm_layer = MetaBatchNormLayer(out_shape[1], track_running_stats=True,
                                                      meta_batch_norm=self.meta_layer,
                                                      no_learnable_params=self.no_bn_learnable_params,
                                                      device=self.device,
                                                      use_per_step_bn_statistics=self.use_per_step_bn_statistics,
                                                      args=self.args)
             elif self.args.norm_layer == "layer_norm":
-                self.norm_layer = MetaLayerNormLayer(input_feature_shape=out.shape[1:])
-
-            out = self.norm_layer(out, num_step=0)
+                self.norm_layer = MetaLayerNormLayer(input_feature_shape=out_shape[1:])
 
-        out = F.leaky_relu(out)
-
-        print(out.shape)
+        self.output_shape = out_shape
 
     def forward(self, x, num_step, params=None, training=False, backup_running_statistics=False):
         """
@@ -707,7 +869,10 @@ class MetaConvNormLayerReLU(nn.Module):
         conv_params = None
         activation_function_pre_params = None
 
-        if params is not None:
+        if isinstance(params, tuple):
+            conv_params = batch_norm_params = params
+
+        elif params is not None:
             params = extract_top_level_dict(current_dict=params)
 
             if self.normalization:
@@ -776,9 +941,6 @@ class MetaNormLayerConvReLU(nn.Module):
 
     def build_block(self):
 
-        x = torch.zeros(self.input_shape)
-
-        out = x
         if self.normalization:
             if self.args.norm_layer == "batch_norm":
                 self.norm_layer = MetaBatchNormLayer(self.input_shape[1], track_running_stats=True,
@@ -788,19 +950,17 @@ class MetaNormLayerConvReLU(nn.Module):
                                                      use_per_step_bn_statistics=self.use_per_step_bn_statistics,
                                                      args=self.args)
             elif self.args.norm_layer == "layer_norm":
-                self.norm_layer = MetaLayerNormLayer(input_feature_shape=out.shape[1:])
+                self.norm_layer = MetaLayerNormLayer(input_feature_shape=self.input_shape[1:])
 
-            out = self.norm_layer.forward(out, num_step=0)
-        self.conv = MetaConv2dLayer(in_channels=out.shape[1], out_channels=self.num_filters,
+        self.conv = MetaConv2dLayer(in_channels=self.input_shape[1], out_channels=self.num_filters,
                                     kernel_size=self.kernel_size,
                                     stride=self.stride, padding=self.padding, use_bias=self.use_bias)
 
 
         self.layer_dict['activation_function_pre'] = nn.LeakyReLU()
 
-
-        out = self.layer_dict['activation_function_pre'].forward(self.conv.forward(out))
-        print(out.shape)
+        self.output_shape = conv_output_shape(self.input_shape, self.num_filters, self.kernel_size, self.stride,
+                                              self.padding)
 
     def forward(self, x, num_step, params=None, training=False, backup_running_statistics=False):
         """
@@ -817,7 +977,10 @@ class MetaNormLayerConvReLU(nn.Module):
         """
         batch_norm_params = None
 
-        if params is not None:
+        if isinstance(params, tuple):
+            conv_params = batch_norm_params = params
+
+        elif params is not None:
             params = extract_top_level_dict(current_dict=params)
 
             if self.normalization:
@@ -887,17 +1050,15 @@ class VGGReLUNormNetwork(nn.Module):
 
     def build_network(self):
         """
-        Builds the network before inference is required by creating some dummy inputs with the same input as the
-        self.im_shape tuple. Then passes that through the network and dynamically computes input shapes and
-        sets output shapes for each layer.
+        Builds the network before inference is required. The input shape of each layer is computed from the
+        self.im_shape tuple analytically, layer by layer, rather than by passing dummy inputs through the network.
         """
-        x = torch.zeros(self.input_shape)
-        out = x
+        out_shape = torch.Size(self.input_shape)
         self.layer_dict = nn.ModuleDict()
-        self.upscale_shapes.append(x.shape)
+        self.upscale_shapes.append(out_shape)
 
         for i in range(self.num_stages):
-            self.layer_dict['conv{}'.format(i)] = MetaConvNormLayerReLU(input_shape=out.shape,
+            self.layer_dict['conv{}'.format(i)] = MetaConvNormLayerReLU(input_shape=out_shape,
                                                                         num_filters=self.cnn_filters,
                                                                         kernel_size=3, stride=self.conv_stride,
                                                                         padding=self.args.conv_padding,
@@ -906,48 +1067,52 @@ class VGGReLUNormNetwork(nn.Module):
                                                                         meta_layer=self.meta_classifier,
                                                                         no_bn_learnable_params=False,
                                                                         device=self.device)
-            out = self.layer_dict['conv{}'.format(i)](out, training=True, num_step=0)
+            out_shape = self.layer_dict['conv{}'.format(i)].output_shape
 
             if self.args.max_pooling:
-                out = F.max_pool2d(input=out, kernel_size=(2, 2), stride=2, padding=0)
+                out_shape = pool_output_shape(out_shape, kernel_size=2, stride=2, padding=0)
 
 
         if not self.args.max_pooling:
-            out = F.avg_pool2d(out, out.shape[2])
+            out_shape = pool_output_shape(out_shape, kernel_size=out_shape[2], stride=out_shape[2])
 
-        self.encoder_features_shape = list(out.shape)
-        out = out.view(out.shape[0], -1)
+        self.encoder_features_shape = list(out_shape)
 
-        self.layer_dict['linear'] = MetaLinearLayer(input_shape=(out.shape[0], np.prod(out.shape[1:])),
+        self.layer_dict['linear'] = MetaLinearLayer(input_shape=(out_shape[0], np.prod(out_shape[1:])),
                                                     num_filters=self.num_output_classes, use_bias=True)
 
-        out = self.layer_dict['linear'](out)
-        print("VGGNetwork build", out.shape)
+        print("VGGNetwork build", (out_shape[0], self.num_output_classes))
 
     def forward(self, x, num_step, params=None, training=False, backup_running_statistics=False):
         """
         Forward propages through the network. If any params are passed then they are used instead of stored params.
-        :param x: Input image batch.
+        :param x: Input image batch, of shape b, c, h, w. Several tasks can be run at once by stacking their images
+        along the channel dimension (b, num_tasks * c, h, w) and passing params with a leading num_tasks dimension.
         :param num_step: The current inner loop step number
         :param params: If params are None then internal parameters are used. If params are a dictionary with keys the
-         same as the layer names then they will be used instead.
+         same as the layer names then they will be used instead. A tuple of fast weights, ordered as the names given to
+         set_fast_weight_names, is passed straight to the layers.
         :param training: Whether this is training (True) or eval time.
         :param backup_running_statistics: Whether to backup the running statistics in their backup store. Which is
         then used to reset the stats back to a previous state (usually after an eval loop, when we want to throw away stored statistics)
-        :return: Logits of shape b, num_output_classes.
+        :return: Logits of shape b, num_tasks * num_output_classes.
         """
         param_dict = dict()
+        num_tasks = x.shape[1] // self.input_shape[1]
+
+        if isinstance(params, tuple):
+            param_dict = dict.fromkeys(self.layer_dict.keys(), params)
 
-        if params is not None:
-            params = {key: value[0] for key, value in params.items()}
-            param_dict = extract_top_level_dict(current_dict=params)
+        else:
+            if params is not None:
+                param_dict = extract_top_level_dict(current_dict=params)
 
-        # print('top network', param_dict.keys())
-        for name, param in self.layer_dict.named_parameters():
-            path_bits = name.split(".")
-            layer_name = path_bits[0]
-            if layer_name not in param_dict:
-                param_dict[layer_name] = None
+            # print('top network', param_dict.keys())
+            for name, param in self.layer_dict.named_parameters():
+                path_bits = name.split(".")
+                layer_name = path_bits[0]
+                if layer_name not in param_dict:
+                    param_dict[layer_name] = None
 
         out = x
 
@@ -961,10 +1126,10 @@ class VGGReLUNormNetwork(nn.Module):
         if not self.args.max_pooling:
             out = F.avg_pool2d(out, out.shape[2])
 
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), num_tasks, -1).transpose(0, 1)
         out = self.layer_dict['linear'](out, param_dict['linear'])
 
-        return out
+        return out.transpose(0, 1).reshape(x.shape[0], -1)
 
     def re_init(self):
         #for param in self.parameters():
@@ -972,22 +1137,24 @@ class VGGReLUNormNetwork(nn.Module):
             if param.requires_grad and 'weight' in name and 'norm' not in name:
                 nn.init.xavier_uniform_(param)
 
+    def set_fast_weight_names(self, names):
+        """
+        Sets the order in which fast weights are passed to forward as a tuple.
+        :param names: The names of the fast weights, as in self.named_parameters()
+        """
+        assign_fast_weight_slots(self, names)
+
     def zero_grad(self, params=None):
         if params is None:
             for param in self.parameters():
                 if param.requires_grad == True:
                     if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
+                        param.grad.zero_()
         else:
             for name, param in params.items():
                 if param.requires_grad == True:
                     if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-                            params[name].grad = None
+                        params[name].grad = None
 
     def restore_backup_stats(self):
         """
@@ -1035,20 +1202,18 @@ class ResNet12(nn.Module):
 
     def build_network(self):
         """
-        Builds the network before inference is required by creating some dummy inputs with the same input as the
-        self.im_shape tuple. Then passes that through the network and dynamically computes input shapes and
-        sets output shapes for each layer.
+        Builds the network before inference is required. The input shape of each layer is computed from the
+        self.im_shape tuple analytically, layer by layer, rather than by passing dummy inputs through the network.
         """
-        x = torch.zeros(self.input_shape)
-        out = x
+        out_shape = torch.Size(self.input_shape)
         self.layer_dict = nn.ModuleDict()
-        self.upscale_shapes.append(x.shape)
+        self.upscale_shapes.append(out_shape)
 
         num_chn = [64, 128, 256, 512]
         max_padding = [0, 0, 1, 1]
         maxpool = [True,True,True,False]
         for i in range(len(num_chn)):
-            self.layer_dict['layer{}'.format(i)] = MetaMaxResLayerReLU(input_shape=out.shape,
+            self.layer_dict['layer{}'.format(i)] = MetaMaxResLayerReLU(input_shape=out_shape,
                                                                     num_filters=num_chn[i],
                                                                     kernel_size=3, stride=1,
                                                                     padding=1,
@@ -1061,44 +1226,48 @@ class ResNet12(nn.Module):
                                                                     downsample=False,
                                                                     max_padding=max_padding[i],
                                                                     maxpool=maxpool[i])
-            out = self.layer_dict['layer{}'.format(i)](out, training=True, num_step=0)
-
-        out = F.adaptive_avg_pool2d(out, (1,1))
+            out_shape = self.layer_dict['layer{}'.format(i)].output_shape
 
-        out = out.view(out.shape[0], -1)
+        # adaptive average pooling to (1, 1)
+        out_shape = out_shape[:2]
 
-        self.layer_dict['linear'] = MetaLinearLayer(input_shape=(out.shape[0], np.prod(out.shape[1:])),
+        self.layer_dict['linear'] = MetaLinearLayer(input_shape=(out_shape[0], np.prod(out_shape[1:])),
                                                     num_filters=self.num_output_classes, use_bias=True)
 
-        out = self.layer_dict['linear'](out)
-        print("ResNet12 build", out.shape)
+        print("ResNet12 build", (out_shape[0], self.num_output_classes))
 
     def forward(self, x, num_step, params=None, training=False, backup_running_statistics=False):
         """
         Forward propages through the network. If any params are passed then they are used instead of stored params.
-        :param x: Input image batch.
+        :param x: Input image batch, of shape b, c, h, w. Several tasks can be run at once by stacking their images
+        along the channel dimension (b, num_tasks * c, h, w) and passing params with a leading num_tasks dimension.
         :param num_step: The current inner loop step number
         :param params: If params are None then internal parameters are used. If params are a dictionary with keys the
-         same as the layer names then they will be used instead.
+         same as the layer names then they will be used instead. A tuple of fast weights, ordered as the names given to
+         set_fast_weight_names, is passed straight to the layers.
         :param training: Whether this is training (True) or eval time.
         :param backup_running_statistics: Whether to backup the running statistics in their backup store. Which is
         then used to reset the stats back to a previous state (usually after an eval loop, when we want to throw away stored statistics)
-        :return: Logits of shape b, num_output_classes.
+        :return: Logits of shape b, num_tasks * num_output_classes.
         """
         param_dict = dict()
+        num_tasks = x.shape[1] // self.input_shape[1]
 
-        if params is not None:
-            #param_dict = parallel_extract_top_level_dict(current_dict=params)
+        if isinstance(params, tuple):
+            param_dict = dict.fromkeys(self.layer_dict.keys(), params)
 
-            params = {key: value[0] for key, value in params.items()}
-            param_dict = extract_top_level_dict(current_dict=params)
+        else:
+            if params is not None:
+                #param_dict = parallel_extract_top_level_dict(current_dict=params)
+
+                param_dict = extract_top_level_dict(current_dict=params)
 
-        # print('top network', param_dict.keys())
-        for name, param in self.layer_dict.named_parameters():
-            path_bits = name.split(".")
-            layer_name = path_bits[0]
-            if layer_name not in param_dict:
-                param_dict[layer_name] = None
+            # print('top network', param_dict.keys())
+            for name, param in self.layer_dict.named_parameters():
+                path_bits = name.split(".")
+                layer_name = path_bits[0]
+                if layer_name not in param_dict:
+                    param_dict[layer_name] = None
 
         out = x
 
@@ -1108,136 +1277,46 @@ class ResNet12(nn.Module):
                                                   num_step=num_step)
 
         out = F.adaptive_avg_pool2d(out, (1,1))
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), num_tasks, -1).transpose(0, 1)
         out = self.layer_dict['linear'](out, param_dict['linear'])
 
-        return out
-
-    def zero_grad(self, params=None):
-        if params is None:
-            for param in self.parameters():
-                if param.requires_grad == True:
-                    if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-        else:
-            for name, param in params.items():
-                if param.requires_grad == True:
-                    if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-                            params[name].grad = None
+        return out.transpose(0, 1).reshape(x.shape[0], -1)
 
-    def restore_backup_stats(self):
+    def set_fast_weight_names(self, names):
         """
-        Reset stored batch statistics from the stored backup.
+        Sets the order in which fast weights are passed to forward as a tuple.
+        :param names: The names of the fast weights, as in self.named_parameters()
         """
-        #self.layer_dict['conv0'].restore_backup_stats()
-        for i in range(self.num_stages):
-            self.layer_dict['layer{}'.format(i)].restore_backup_stats()
-
-class MetaStepLossNetwork(nn.Module):
-    def __init__(self, input_dim, args, device):
-        super(MetaStepLossNetwork, self).__init__()
-
-        self.device = device
-        self.args = args
-        self.input_dim = input_dim
-        self.input_shape = (1, input_dim)
-
-        self.build_network()
-        print("meta network params")
-        for name, param in self.named_parameters():
-            print(name, param.shape)
-
-    def build_network(self):
-        """ 
-        Builds the network before inference is required by creating some dummy inputs with the same input as the
-        self.im_shape tuple. Then passes that through the network and dynamically computes input shapes and
-        sets output shapes for each layer.
-        """
-        x = torch.zeros(self.input_shape)
-        out = x
-
-        self.linear1 = MetaLinearLayer(input_shape=self.input_shape,
-                                                    num_filters=self.input_dim, use_bias=True)
-
-        self.linear2 = MetaLinearLayer(input_shape=(1, self.input_dim),
-                                                    num_filters=1, use_bias=True)
-
-
-        out = self.linear1(out)
-        out = F.relu_(out)
-        out = self.linear2(out)
-
-    def forward(self, x, params=None):
-        """                                  
-        Forward propages through the network. If any params are passed then they are used instead of stored params.
-        :param x: Input image batch.
-        :param num_step: The current inner loop step number
-        :param params: If params are None then internal parameters are used. If params are a dictionary with keys the
-         same as the layer names then they will be used instead.
-        :param training: Whether this is training (True) or eval time.
-        :param backup_running_statistics: Whether to backup the running statistics in their backup store. Which is
-        then used to reset the stats back to a previous state (usually after an eval loop, when we want to throw away stored statistics)
-        :return: Logits of shape b, num_output_classes.
-        """ 
-
-        linear1_params = None
-        linear2_params = None
-
-        if params is not None:
-            params = extract_top_level_dict(current_dict=params)
-
-            linear1_params = params['linear1']
-            linear2_params = params['linear2']
-
-        out = x
-        
-        out = self.linear1(out, linear1_params)
-        out = F.relu_(out)
-        out = self.linear2(out, linear2_params)
-
-        return out
+        assign_fast_weight_slots(self, names)
 
     def zero_grad(self, params=None):
         if params is None:
             for param in self.parameters():
                 if param.requires_grad == True:
                     if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
+                        param.grad.zero_()
         else:
             for name, param in params.items():
                 if param.requires_grad == True:
                     if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-                            params[name].grad = None
+                        params[name].grad = None
 
     def restore_backup_stats(self):
         """
         Reset stored batch statistics from the stored backup.
         """
+        #self.layer_dict['conv0'].restore_backup_stats()
         for i in range(self.num_stages):
-            self.layer_dict['conv{}'.format(i)].restore_backup_stats()
-
+            self.layer_dict['layer{}'.format(i)].restore_backup_stats()
 
 class MetaLossNetwork(nn.Module):
     def __init__(self, input_dim, args, device):
         """
-        Builds a multilayer convolutional network. It also provides functionality for passing external parameters to be
-        used at inference time. Enables inner loop optimization readily.
-        :param im_shape: The input image batch shape.
-        :param num_output_classes: The number of output classes of the network.
+        Builds the meta-learned loss networks of all inner loop steps, two layer MLPs that map the state of a task to
+        its loss. It also provides functionality for passing external parameters to be used at inference time.
+        :param input_dim: The dimensionality of the task state.
         :param args: A named tuple containing the system's hyperparameters.
         :param device: The device to run this on.
-        :param meta_classifier: A flag indicating whether the system's meta-learning (inner-loop) functionalities should
-        be enabled. 
         """
         super(MetaLossNetwork, self).__init__()
 
@@ -1254,66 +1333,67 @@ class MetaLossNetwork(nn.Module):
             print(name, param.shape)
 
     def build_network(self):
-        """ 
-        Builds the network before inference is required by creating some dummy inputs with the same input as the
-        self.im_shape tuple. Then passes that through the network and dynamically computes input shapes and
-        sets output shapes for each layer.
         """
-        x = torch.zeros(self.input_shape)
-        self.layer_dict = nn.ModuleDict()
-
-        for i in range(self.num_steps): 
-            self.layer_dict['step{}'.format(i)] = MetaStepLossNetwork(self.input_dim, args=self.args, device=self.device)
+        Builds the loss networks. The weights of each layer are stacked along a leading num_steps dimension, so that
+        the loss network of a step is selected by indexing rather than by looking up a separate module.
+        """
+        self.linear1_weights = nn.Parameter(torch.ones(self.num_steps, self.input_dim, self.input_dim))
+        self.linear1_bias = nn.Parameter(torch.zeros(self.num_steps, self.input_dim))
+        self.linear2_weights = nn.Parameter(torch.ones(self.num_steps, 1, self.input_dim))
+        self.linear2_bias = nn.Parameter(torch.zeros(self.num_steps, 1))
 
-            out = self.layer_dict['step{}'.format(i)](x)
+        for i in range(self.num_steps):
+            nn.init.xavier_uniform_(self.linear1_weights[i])
+            nn.init.xavier_uniform_(self.linear2_weights[i])
 
     def forward(self, x, num_step, params=None):
-        """                                  
-        Forward propages through the network. If any params are passed then they are used instead of stored params.
-        :param x: Input image batch.
+        """
+        Forward propagates through the loss network of the current step. If any params are passed then they are used
+        instead of stored params.
+        :param x: The task states, of shape (num_tasks, b, input_dim)
         :param num_step: The current inner loop step number
-        :param params: If params are None then internal parameters are used. If params are a dictionary with keys the
-         same as the layer names then they will be used instead.
-        :param training: Whether this is training (True) or eval time.
-        :param backup_running_statistics: Whether to backup the running statistics in their backup store. Which is
-        then used to reset the stats back to a previous state (usually after an eval loop, when we want to throw away stored statistics)
-        :return: Logits of shape b, num_output_classes.
-        """ 
-        param_dict = dict()
+        :param params: If params are None then the stored weights of the current step are used. Otherwise a tuple of
+        the current step's (linear1 weights, linear1 bias, linear2 weights, linear2 bias), with a leading num_tasks
+        dimension, is used instead.
+        :return: The loss of every task state, of shape (num_tasks, b, 1)
+        """
+        if params is None:
+            params = self.get_step_weights(num_step)
 
-        if params is not None: 
-            params = {key: value[0] for key, value in params.items()}
-            param_dict = extract_top_level_dict(current_dict=params)
-            
-        for name, param in self.layer_dict.named_parameters():
-            path_bits = name.split(".")
-            layer_name = path_bits[0]
-            if layer_name not in param_dict:
-                param_dict[layer_name] = None
-
-            
-        out = x
-        
-        out = self.layer_dict['step{}'.format(num_step)](out, param_dict['step{}'.format(num_step)])
+        linear1_weights, linear1_bias, linear2_weights, linear2_bias = params
+
+        out = meta_linear(x, linear1_weights, linear1_bias)
+        out = F.relu_(out)
+        out = meta_linear(out, linear2_weights, linear2_bias)
 
         return out
 
+    def get_step_weights(self, num_step):
+        """
+        Returns the stored weights of the loss network of a step.
+        :param num_step: The inner loop step number
+        :return: A tuple of (linear1 weights, linear1 bias, linear2 weights, linear2 bias)
+        """
+        return self.linear1_weights[num_step], self.linear1_bias[num_step], self.linear2_weights[num_step], \
+               self.linear2_bias[num_step]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        stack_per_step_state_dict(state_dict, prefix, self.num_steps, {
+            'linear1_weights': 'layer_dict.step{}.linear1.weights', 'linear1_bias': 'layer_dict.step{}.linear1.bias',
+            'linear2_weights': 'layer_dict.step{}.linear2.weights', 'linear2_bias': 'layer_dict.step{}.linear2.bias'})
+        super(MetaLossNetwork, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def zero_grad(self, params=None):
         if params is None:
             for param in self.parameters():
                 if param.requires_grad == True:
                     if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
+                        param.grad.zero_()
         else:
             for name, param in params.items():
                 if param.requires_grad == True:
                     if param.grad is not None:
-                        if torch.sum(param.grad) > 0:
-                            print(param.grad)
-                            param.grad.zero_()
-                            params[name].grad = None
+                        params[name].grad = None
 
     def restore_backup_stats(self):
         """
@@ -1323,53 +1403,66 @@ class MetaLossNetwork(nn.Module):
             self.layer_dict['conv{}'.format(i)].restore_backup_stats()
 
 
-class StepLossAdapter(nn.Module):
-    def __init__(self, input_dim, num_loss_net_layers, args, device):
-        super(StepLossAdapter, self).__init__()
-
-        self.device = device
-        self.args = args
-        output_dim = num_loss_net_layers * 2 * 2 # 2 for weight and bias, another 2 for multiplier and offset
-
-        self.linear1 = nn.Linear(input_dim, input_dim)
-        self.activation = nn.ReLU(inplace=True)
-        self.linear2 = nn.Linear(input_dim, output_dim)
-
-        self.multiplier_bias = nn.Parameter(torch.zeros(output_dim // 2))
-        self.offset_bias = nn.Parameter(torch.zeros(output_dim // 2))
-
-    def forward(self, task_state, num_step, loss_params):
-
-        out = self.linear1(task_state)
-        out = F.relu_(out)
-        out = self.linear2(out)
-
-        generated_multiplier, generated_offset = torch.chunk(out, chunks=2, dim=-1)
-
-        i = 0
-        updated_loss_weights = dict()
-        for key, val in loss_params.items():
-            if 'step{}'.format(num_step) in key:
-                updated_loss_weights[key] = (1 + self.multiplier_bias[i] * generated_multiplier[i]) * val + \
-                                             self.offset_bias[i] * generated_offset[i]
-                i+=1
-
-        return updated_loss_weights
-
-
 class LossAdapter(nn.Module):
     def __init__(self, input_dim, num_loss_net_layers, args, device):
+        """
+        Builds the networks that generate, for every inner loop step, a multiplier and an offset for each weight of the
+        loss network of that step from the state of a task.
+        :param input_dim: The dimensionality of the task state.
+        :param num_loss_net_layers: The number of layers of the loss network that is adapted.
+        :param args: A named tuple containing the system's hyperparameters.
+        :param device: The device to run this on.
+        """
         super(LossAdapter, self).__init__()
 
         self.device = device
         self.args = args
 
         self.num_steps = args.number_of_training_steps_per_iter # number of inner-loop steps
+        output_dim = num_loss_net_layers * 2 * 2 # 2 for weight and bias, another 2 for multiplier and offset
+
+        # the per step adapters are stacked along the first dimension and initialized like nn.Linear layers
+        self.linear1_weight = nn.Parameter(torch.ones(self.num_steps, input_dim, input_dim))
+        self.linear1_bias = nn.Parameter(torch.zeros(self.num_steps, input_dim))
+        self.linear2_weight = nn.Parameter(torch.ones(self.num_steps, output_dim, input_dim))
+        self.linear2_bias = nn.Parameter(torch.zeros(self.num_steps, output_dim))
 
-        self.loss_adapter = nn.ModuleList()
-        for i in range(self.num_steps): 
-            self.loss_adapter.append(StepLossAdapter(input_dim, num_loss_net_layers, args=args, device=device))
+        for i in range(self.num_steps):
+            for weight, bias in ((self.linear1_weight, self.linear1_bias), (self.linear2_weight, self.linear2_bias)):
+                nn.init.kaiming_uniform_(weight[i], a=math.sqrt(5))
+                bound = 1 / math.sqrt(input_dim)
+                nn.init.uniform_(bias[i], -bound, bound)
+
+        self.multiplier_bias = nn.Parameter(torch.zeros(self.num_steps, output_dim // 2))
+        self.offset_bias = nn.Parameter(torch.zeros(self.num_steps, output_dim // 2))
 
     def forward(self, task_state, num_step, loss_params):
-        return self.loss_adapter[num_step](task_state, num_step, loss_params)
+        """
+        Generates the loss network weights of the current step, modulated by the task state of each task.
+        :param task_state: The task states, of shape (num_tasks, input_dim)
+        :param num_step: The current inner loop step number
+        :param loss_params: A dictionary with the loss network weights of all steps, stacked along their first dimension.
+        :return: A tuple with the modulated loss network weights of the current step, of shape (num_tasks, ...)
+        """
+        out = F.linear(task_state, self.linear1_weight[num_step], self.linear1_bias[num_step])
+        out = F.relu_(out)
+        out = F.linear(out, self.linear2_weight[num_step], self.linear2_bias[num_step])
 
+        generated_multiplier, generated_offset = torch.chunk(out, chunks=2, dim=-1)
+        multiplier = 1 + self.multiplier_bias[num_step] * generated_multiplier
+        offset = self.offset_bias[num_step] * generated_offset
+
+        updated_loss_weights = []
+        for i, val in enumerate(loss_params.values()):
+            task_shape = [-1] + [1] * (val.dim() - 1)
+            updated_loss_weights.append(torch.addcmul(offset[:, i].view(task_shape),
+                                                      multiplier[:, i].view(task_shape), val[num_step]))
+
+        return tuple(updated_loss_weights)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        stack_per_step_state_dict(state_dict, prefix, self.num_steps, {
+            'linear1_weight': 'loss_adapter.{}.linear1.weight', 'linear1_bias': 'loss_adapter.{}.linear1.bias',
+            'linear2_weight': 'loss_adapter.{}.linear2.weight', 'linear2_bias': 'loss_adapter.{}.linear2.bias',
+            'multiplier_bias': 'loss_adapter.{}.multiplier_bias', 'offset_bias': 'loss_adapter.{}.offset_bias'})
+        super(LossAdapter, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
@@ -65,6 +65,45 @@ def get_args():
 
     parser.add_argument('--meta_loss', type=str, default="False", help='Whether to use meta loss')
 
+    # Inner loop
+    parser.add_argument('--task_batched_inner_loop', type=str, default="False",
+                        help='Whether to adapt all tasks of a meta-batch at once instead of one task at a time')
+    parser.add_argument('--inner_loop_gradient_checkpointing', type=str, default="False",
+                        help='Whether to recompute the activations of each second order inner loop step during the '
+                             'outer loop backward pass instead of keeping them in memory')
+    parser.add_argument('--implicit_meta_gradient', type=str, default="False",
+                        help='Whether to compute the meta-gradient implicitly at the adapted weights (iMAML) instead of '
+                             'differentiating through the inner loop')
+    parser.add_argument('--implicit_gradient_lambda', type=float, default=1.0,
+                        help='The strength of the proximal regularization of the inner loop for the implicit '
+                             'meta-gradient')
+    parser.add_argument('--implicit_gradient_cg_steps', type=int, default=5,
+                        help='The number of conjugate gradient steps used to solve for the implicit meta-gradient')
+    parser.add_argument('--count_host_syncs', type=str, default="False",
+                        help='Whether to count (and report) the host-device synchronizations of every iteration, which '
+                             'should be 0 outside of the final reduction of its metrics')
+
+    # Precision and memory layout
+    parser.add_argument('--mixed_precision_dtype', type=str, default="float32",
+                        help='The dtype ("bfloat16" or "float16") to run the backbone in with autocast, or "float32" '
+                             'to run everything in full precision')
+    parser.add_argument('--channels_last', type=str, default="False",
+                        help='Whether to run the backbone on channels last (NHWC) images and weights')
+    parser.add_argument('--compile_backbone', type=str, default="False",
+                        help='Whether to run the backbone and meta-loss networks with torch.compile in the passes that '
+                             'are only differentiated once (first order inner loops and evaluation)')
+
+    # Data pipeline
+    parser.add_argument('--packed_dataset', type=str, default="False",
+                        help='Whether to serve episodes from a packed, memory-mapped uint8 copy of each split')
+    parser.add_argument('--persistent_dataloader_workers', type=str, default="False",
+                        help='Whether to create the train/val/test data loaders once and keep their workers alive')
+    parser.add_argument('--device_side_preprocessing', type=str, default="False",
+                        help='Whether to scale, rotate and normalize raw uint8 episodes on the training device')
+    parser.add_argument('--prefetch_to_device', type=str, default="False",
+                        help='Whether to copy the next batch to the device (from pinned memory) while the current '
+                             'one is being used')
+
     args = parser.parse_args()
     args_dict = vars(args)
     if args.name_of_args_json_file is not "None":